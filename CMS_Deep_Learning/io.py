@@ -4,8 +4,12 @@ import h5py
 import glob
 import copy
 import itertools
+import threading
+import multiprocessing
+from collections import deque
 from six import string_types,reraise
-from CMS_Deep_Learning.storage.archiving import DataProcedure,KerasTrial
+from six.moves import queue
+from CMS_Deep_Learning.storage.archiving import DataProcedure,KerasTrial,open_h5
 
 
 # -----------------------------IO Utils----------------------------------------
@@ -23,7 +27,8 @@ def load_hdf5_dataset(data):
     return data
 
 
-def retrieve_data(data, data_keys, just_length=False, assert_list=False, prep_func=None, data_format='h5', verbose=0):
+def retrieve_data(data, data_keys, just_length=False, assert_list=False, prep_func=None, data_format='h5', driver=None,
+                  verbose=0):
     '''Grabs raw data from a DataProcedure or file
 
         :param data: the data to get the raw verion of. If not str or DataProcedure returns itself
@@ -41,6 +46,9 @@ def retrieve_data(data, data_keys, just_length=False, assert_list=False, prep_fu
         :type prep_func: function
         :param data_format: 'pandas' or 'h5' depending on how file was created
         :type data_format: string
+        :param driver: The h5py driver to open .h5 files and DataProcedure archives with. 'core' reads each file
+                        into memory in one pass instead of one read per chunk.
+        :type driver: str
         :param verbose: whether or not to print out extra internal information
         :type verbose: int
         :returns: The raw data as numpy.ndarray
@@ -58,7 +66,7 @@ def retrieve_data(data, data_keys, just_length=False, assert_list=False, prep_fu
     if (isPandas): data_format = "pandas"
 
     if (isinstance(data, DataProcedure)):
-        return f_ret(data.get_data(data_keys=data_keys, verbose=verbose))
+        return f_ret(data.get_data(data_keys=data_keys, driver=driver, verbose=verbose))
 
     elif (isFileObject or isinstance(data, string_types)):
         if (isFileObject):
@@ -66,7 +74,7 @@ def retrieve_data(data, data_keys, just_length=False, assert_list=False, prep_fu
         else:
             f_path = os.path.abspath(data)
             if (data_format == 'h5'):
-                h5_file = h5py.File(f_path, 'r') if not ish5 else data
+                h5_file = open_h5(f_path, driver=driver) if not ish5 else data
             elif (data_format == 'pandas'):
                 import pandas as pd
                 h5_file = pd.HDFStore(f_path, 'r') if not isPandas else data
@@ -76,7 +84,7 @@ def retrieve_data(data, data_keys, just_length=False, assert_list=False, prep_fu
         if isinstance(data_keys, (list, tuple)):
             # Get Recursively if keys are list
             out = [retrieve_data(h5_file, data_keys=data_key, just_length=just_length, assert_list=False,
-                                 data_format=data_format)
+                                 data_format=data_format, driver=driver)
                    for data_key in data_keys]
         else:
             # Grab directly from the HDF5 store
@@ -189,7 +197,79 @@ def _size_set(x, s=None):
     return s
 
 
-def gen_from_data(lst, batch_size, data_keys=["Particles", "Labels"], prep_func=None, data_format='h5', verbose=1):
+def _prefetch(iterable, size):
+    '''A helper method that runs through iterable in a background thread, keeping up to size items ready in a
+        queue. Exceptions raised by iterable are reraised in the consuming thread.'''
+    q = queue.Queue(maxsize=size)
+    done = object()
+    stop = threading.Event()
+
+    def put(entry):
+        # Check for stop every so often so that the thread ends if the consumer goes away
+        while not stop.is_set():
+            try:
+                q.put(entry, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if (not put((item, None))): return
+            put((done, None))
+        except Exception:
+            put((done, sys.exc_info()))
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exc_info = q.get()
+            if (exc_info != None): reraise(*exc_info)
+            if (item is done): return
+            yield item
+    finally:
+        stop.set()
+
+
+def _read_flat(args):
+    '''A helper method that reads one file or DataProcedure as a flat list of arrays. Takes a single tuple
+        (data, data_keys, prep_func, data_format, driver, verbose) so that it can be mapped over a multiprocessing.Pool.'''
+    data, data_keys, prep_func, data_format, driver, verbose = args
+    return flatten(assert_list(
+        retrieve_data(data, data_keys=data_keys, prep_func=prep_func, data_format=data_format, driver=driver,
+                      verbose=verbose)), inplace=True)
+
+
+def _read_ahead(pool, func, items, size):
+    '''A helper method that yields func(item) for each item in order, computing them in pool with at most size
+        of them submitted at any time.'''
+    pending = deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if (len(pending) >= size):
+            yield pending.popleft().get()
+    while (len(pending) > 0):
+        yield pending.popleft().get()
+
+
+def _copy_to_buffers(batch, buffers, batch_size):
+    '''A helper method that copies each array in batch into the matching array in buffers, allocating buffers for
+        batch_size samples if they are missing or do not fit. Returns the buffers and the views of them holding the batch.'''
+    if (buffers == None or len(buffers) != len(batch) or
+            True in [b.shape[1:] != x.shape[1:] or b.dtype != x.dtype for b, x in zip(buffers, batch)]):
+        buffers = [_empty_like_samples(x, batch_size) for x in batch]
+    out = [b[:len(x)] for b, x in zip(buffers, batch)]
+    for o, x in zip(out, batch):
+        np.copyto(o, x)
+    return buffers, out
+
+
+def gen_from_data(lst, batch_size, data_keys=["Particles", "Labels"], prep_func=None, data_format='h5', prefetch=0,
+                  cache_megabytes=0, num_buffers=0, num_processes=1, driver=None, verbose=1):
     '''Gets a generator that generates data of **batch_size** from a list of .h5 files or DataProcedures,
         or a directory containing .h5 files.
 
@@ -204,6 +284,23 @@ def gen_from_data(lst, batch_size, data_keys=["Particles", "Labels"], prep_func=
         :type prep_func: function
         :param data_format: 'pandas' or 'h5' depending on how file was created
         :type data_format: string
+        :param prefetch: If greater than 0, how many files/DataProcedures to read ahead in a background thread
+                        while batches are being consumed.
+        :type prefetch: int
+        :param cache_megabytes: How many megabytes of read data to keep in memory so that later epochs do not have to
+                        read it again. Files/DataProcedures are kept in order until the budget is used up. The batches
+                        of cached data are views into the cache so they should not be modified.
+        :type cache_megabytes: float
+        :param num_buffers: If greater than 0, each batch is copied into one of num_buffers preallocated sets of
+                        contiguous arrays, used in turn, instead of being yielded as views of the read data. A batch
+                        is overwritten num_buffers batches later so it should be used (or copied) before then.
+        :type num_buffers: int
+        :param num_processes: If greater than 1, how many processes to read files/DataProcedures with. Up to
+                        2*num_processes of them are read at once, and their data is used in order. prep_func must
+                        be picklable (i.e not a lambda) when using more than one process.
+        :type num_processes: int
+        :param driver: The h5py driver to read .h5 files and DataProcedure archives with (see retrieve_data)
+        :type driver: str
         :param verbose: whether or not to print out info to the user.
         :type verbose: int
         :returns: a generator that runs through the given data
@@ -221,19 +318,54 @@ def gen_from_data(lst, batch_size, data_keys=["Particles", "Labels"], prep_func=
             else:
                 raise TypeError("List elements should be existing file path or DataProcedure but got %r" % type(d))
 
-    while True:
-        for i, elmt in enumerate(lst):
-            flat_out = flatten(assert_list(
-                retrieve_data(elmt, data_keys=data_keys, prep_func=prep_func, data_format=data_format,
-                              verbose=verbose)), inplace=True)
-            tot_set = _size_set(flat_out)
-            assert len(tot_set) == 1, "datasets (i.e %r) do not have same number of elements" % flatten(data_keys)[:3]
-            tot = list(tot_set)[0]
-            for start in range(0, tot, batch_size):
-                end = start + min(batch_size, tot - start)
-                if end <= start: continue
-                # yield tuple([[x[start:end] for x in X] for X in out])
-                yield restructure([x[start:end] for x in flat_out], data_keys)
+    # Since the data is read in the same order every epoch an LRU cache would always evict the next thing we need,
+    # so just keep the first elements that fit in the budget.
+    cache = {}
+    cache_bytes = [0, cache_megabytes * 1000.0 * 1000.0]
+    def read_epoch(results):
+        # results holds the data of the elements that were not cached at the start of the epoch, in order
+        for i in range(len(lst)):
+            if (i in cache):
+                yield cache[i]
+                continue
+            flat_out = next(results)
+            nbytes = sum([getattr(x, 'nbytes', 0) for x in flat_out])
+            if (cache_bytes[0] + nbytes <= cache_bytes[1]):
+                cache[i] = flat_out
+                cache_bytes[0] += nbytes
+            yield flat_out
+
+    def read_all():
+        pool = multiprocessing.Pool(num_processes) if num_processes > 1 else None
+        try:
+            while True:
+                reads = [(elmt, data_keys, prep_func, data_format, driver, verbose)
+                         for i, elmt in enumerate(lst) if not i in cache]
+                if (pool != None):
+                    results = _read_ahead(pool, _read_flat, reads, 2 * num_processes)
+                else:
+                    results = (_read_flat(args) for args in reads)
+                for flat_out in read_epoch(results):
+                    yield flat_out
+        finally:
+            if (pool != None):
+                pool.terminate()
+
+    # The nesting of data_keys is the same for every batch
+    structure = restructurer(data_keys)
+    ring = [None] * num_buffers
+    k = 0
+    for flat_out in (_prefetch(read_all(), prefetch) if prefetch > 0 else read_all()):
+        tot_set = _size_set(flat_out)
+        assert len(tot_set) == 1, "datasets (i.e %r) do not have same number of elements" % flatten(data_keys)[:3]
+        tot = list(tot_set)[0]
+        for start in range(0, tot, batch_size):
+            # Slicing stops at the end of the data so the last batch is just shorter
+            batch = [x[start:start + batch_size] for x in flat_out]
+            if (num_buffers > 0):
+                ring[k], batch = _copy_to_buffers(batch, ring[k], batch_size)
+                k = (k + 1) % num_buffers
+            yield structure(batch)
 
 
 # --------------------------------------------------------------
@@ -278,6 +410,25 @@ def restructure(flattened, data_keys, seqtypes=(list, tuple)):
         pos += k
     return out
 
+def restructurer(data_keys, seqtypes=(list, tuple)):
+    '''Returns a function equivalent to lambda flattened: restructure(flattened, data_keys), with the nesting
+        of data_keys worked out once up front. Useful when restructuring many lists with the same data_keys.
+        If data_keys is flat, a list with one element per key is returned as is instead of being copied.'''
+    if (not isinstance(data_keys, seqtypes)):
+        return lambda flattened: flattened[0] if isinstance(flattened, seqtypes) else flattened
+    n = len(data_keys)
+    if (not True in [isinstance(key, seqtypes) for key in data_keys]):
+        # Each key is a single array, so the structure is just the flat list
+        return lambda flattened: flattened if isinstance(flattened, list) and len(flattened) == n \
+                                 else list(flattened[:n])
+    parts = []
+    pos = 0
+    for key in data_keys:
+        k = len(flatten(key)) if isinstance(key, seqtypes) else 1
+        parts.append((pos, pos + k, restructurer(key, seqtypes=seqtypes)))
+        pos += k
+    return lambda flattened: [f(flattened[start:end]) for start, end, f in parts]
+
 def first_elmt(x,seqtypes=(list, tuple)):
     '''Gets the first non-list element of any set of nested lists'''
     if isinstance(x,seqtypes):
@@ -300,6 +451,14 @@ else:
     getNumParams = lambda f: len(getargspec(f)[0])
 
 
+def _empty_like_samples(x, num_samples):
+    '''A helper method that allocates an array for num_samples samples shaped like the samples in x'''
+    # Arrays and h5py datasets give their shape and dtype without being read
+    if (not hasattr(x, "shape") or not hasattr(x, "dtype")):
+        x = np.asarray(x)
+    return np.empty((num_samples,) + x.shape[1:], dtype=x.dtype)
+
+
 class DataIterator:
     '''A tool for retrieving inputs, labels,prediction values and functions of data.
         Unlike gen_from_data aggregates data from multiple files together into a single list. 
@@ -411,10 +570,10 @@ class DataIterator:
         samples_outs = [None] * len(self.union_keys)
 
         # Just make sure that self.num_samples is resolved
-        self.length()
+        num_samples = self.length(verbose=verbose)
 
-        acc_out = [None] * self.length(verbose=verbose) if (self.accumulate != None) else None
-        pred_out = [None] * self.length(verbose=verbose) if (self.prediction_model != None) else None
+        # Outputs are preallocated once the shape of each one is known and then filled chunk by chunk
+        acc_out, pred_out = None, None
 
         # Loop through the data, compute predictions and accum and put it in a list
         nb_data = len(self.data)
@@ -429,6 +588,8 @@ class DataIterator:
                 break
             out = self._assert_raw(d, verbose=verbose)
             L = first_elmt(out).shape[0]
+            # Don't read past num_samples
+            n = min(L, num_samples - pos)
             for i, Z in enumerate(out):
                 if (isinstance(Z, tuple)): Z = list(Z)
                 if (not isinstance(Z, list)): Z = [Z]
@@ -436,38 +597,40 @@ class DataIterator:
                 if (i == self.label_index): Y = Z
 
                 flat_Z = flatten(Z)
-                if (samples_outs[i] == None):
-                    samples_outs[i] = [[None] * self.length(verbose=verbose) for _ in
-                                       range(len(flat_Z))]
+                if (samples_outs[i] is None):
+                    samples_outs[i] = [_empty_like_samples(z, num_samples) for z in flat_Z]
                 for j, z in enumerate(flat_Z):
-                    Zj_out = samples_outs[i][j]
-                    for k in range(L):
-                        Zj_out[pos + k] = z[k]
+                    samples_outs[i][j][pos:pos + n] = z[:n]
             if (self.prediction_model != None):
-                pred = self.prediction_model.predict_on_batch(X)
-                for j in range(L):
-                    pred_out[pos + j] = pred[j]
+                pred = np.asarray(self.prediction_model.predict_on_batch(X))
+                if (pred_out is None): pred_out = _empty_like_samples(pred, num_samples)
+                pred_out[pos:pos + n] = pred[:n]
 
             if (self.accumulate != None):
                 if (self.num_params == 1):
                     acc = self.accumulate(X)
                 else:
                     acc = self.accumulate(X, Y)
-                for j in range(L):
-                    acc_out[pos + j] = acc[j]
-            pos += L
+                acc = np.asarray(acc)
+                if (acc_out is None): acc_out = _empty_like_samples(acc, num_samples)
+                acc_out[pos:pos + n] = acc[:n]
+            pos += n
+
+        # The data may run out before num_samples, drop the rows that were never filled
+        if (pos < num_samples):
+            samples_outs = [Z_out if Z_out is None else [z[:pos] for z in Z_out] for Z_out in samples_outs]
+            if (pred_out is not None): pred_out = pred_out[:pos]
+            if (acc_out is not None): acc_out = acc_out[:pos]
         out = []
         for key in assert_list(self.data_keys):
             Z_out = samples_outs[self.union_keys.index(key)]
-            if (Z_out != None):
-                for j, zo in enumerate(Z_out):
-                    Z_out[j] = np.array(zo)
+            if (Z_out is not None):
                 Z_out = restructure(Z_out, key)
                 out.append(Z_out)
-        if (pred_out != None):
-            out.append(np.array(pred_out))
-        if (acc_out != None):
-            out.append(np.array(acc_out))
+        if (pred_out is not None):
+            out.append(pred_out)
+        if (acc_out is not None):
+            out.append(acc_out)
         return out[0] if len(out) == 1 and self.key_singluar else tuple(out)
 
     def next(self):
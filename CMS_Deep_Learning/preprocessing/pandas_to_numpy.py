@@ -102,24 +102,13 @@ def numpy_from_h5(f, file_start_read, samples_to_read, file_total_events=-1, for
 
 
 # ---------------------------HELPERS---------------------------
-def _gen_label_vecs(data_dirs):
-    num_labels = len(data_dirs)
-    label_vecs = {}
-    for i, data_dir in enumerate(data_dirs):
-        arr = np.zeros((num_labels,))
-        arr[i] = 1
-        label_vecs[data_dir] = arr
-    return label_vecs
-
-
 def _initializeArrays(data_dirs, samples_per_class):
-    '''Helper Function - Generates the initial data structures for the X (data) and Y (target)'''
+    '''Helper Function - Generates the initial data structures for the X (data), HLF and sources'''
     num_classes = len(data_dirs)
     X_train = [None] * (samples_per_class * num_classes)
-    y_train = [None] * (samples_per_class * num_classes)
     HLF_train = [None] * (samples_per_class * num_classes)
     sources_train = [None] * (samples_per_class * num_classes)
-    return X_train, y_train, HLF_train, sources_train
+    return X_train, HLF_train, sources_train
 
 
 # -------------------------------------------------------------
@@ -267,11 +256,9 @@ def to_shuffled_numpy(data_dirs, start, samples_per_class,
     if (isinstance(data_dirs[0], tuple)): data_dirs = [x[1] for x in data_dirs]
     _check_inputs(data_dirs, observ_types)
 
-    label_vecs = _gen_label_vecs(data_dirs)
-    X_train, y_train, HLF_train, sources_train = _initializeArrays(data_dirs, samples_per_class)
+    X_train, HLF_train, sources_train = _initializeArrays(data_dirs, samples_per_class)
     X_train_index = 0
 
-    y_train_start = 0
     for data_dir in data_dirs:
         files = glob.glob(os.path.abspath(data_dir) + "/*.h5")
         files.sort()
@@ -369,14 +356,11 @@ def to_shuffled_numpy(data_dirs, start, samples_per_class,
             raise IOError(
                 "Not enough data in %r to read in range(%r, %r)" % (data_dir, start, samples_per_class + start))
 
-        # Generate the target data as vectors like [1,0,0], [0,1,0], [0,0,1]
-        for i in range(samples_per_class):
-            y_train[y_train_start + i] = label_vecs[data_dir]
-        y_train_start += samples_per_class
+    # Generate the target data as vectors like [1,0,0], [0,1,0], [0,0,1], the directories are read in order
+    y_train = np.repeat(np.eye(len(data_dirs)), samples_per_class, axis=0)
 
     # Turn everything into numpy arrays and shuffle them just in case.
     # Although, we probably don't need to shuffle since keras shuffles by default.
-    y_train = np.array(y_train)
 
     indices = np.arange(len(y_train))
     np.random.shuffle(indices)
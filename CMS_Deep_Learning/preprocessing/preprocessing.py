@@ -1,9 +1,9 @@
-import glob
+import ast
 import os
 import re
 import sys
-import threading
-import time
+import multiprocessing
+from collections import OrderedDict, Counter
 
 import numpy as np
 import pandas as pd
@@ -12,8 +12,15 @@ from six import string_types,reraise
 
 from CMS_Deep_Learning.storage.archiving import DataProcedure,read_json_obj,write_json_obj
 from CMS_Deep_Learning.storage.meta import msgpack_assertMeta
-from CMS_Deep_Learning.io import get_sizes_meta_dict, size_from_meta,gen_from_data
+from CMS_Deep_Learning.io import get_sizes_meta_dict, gen_from_data
+from CMS_Deep_Learning.utils._preproc_kernels import pad_sort_block
 
+#numexpr evaluates ObjectProfile.query expressions in a single pass, but it is optional
+try:
+    import numexpr
+    QUERY_ENGINE = 'numexpr'
+except ImportError:
+    QUERY_ENGINE = 'python'
 
 
 DEFAULT_PROFILE = {
@@ -101,7 +108,17 @@ EVENT_CHARS = ['MET','HT','MuonMul','ElectronMul','JetMul','MaxJetPT', 'MaxLepPT
 
 JET_OUTPUT_OBSERVS = ['E/c', 'Px', 'Py', 'Pz'] + JET_OBSERVS
 
-def resolveProfileMaxes(object_profiles, label_dir_pairs, padding_multiplier = 1.0):
+def _fileMaxes(task):
+    '''Helper Function - Gets the maximum number of values per entry for each of the names in task=(f, storeType, names)
+        or None if the file cannot be read'''
+    f, storeType, names = task
+    num_val_frame = getNumValFrame(f,storeType)
+    if(isinstance(num_val_frame, type(None))):
+        print("Skipping %r" % f)
+        return None
+    return num_val_frame[names].max().to_dict()
+
+def resolveProfileMaxes(object_profiles, label_dir_pairs, padding_multiplier = 1.0, num_processes=1):
     '''Resolves the maximum number of objects for each ObjectProfile. Only runs if ObjectProfile.max_size
         is equal to -1 or None indicating that the value is unresolved. By resolving our max_size(s) we
         can make our preprocessing data sets as small as possible without truncating any data.
@@ -113,6 +130,7 @@ def resolveProfileMaxes(object_profiles, label_dir_pairs, padding_multiplier = 1
             padding_ratio   -- A muliplier to either shrink or increase the size of the maxes
                                 in case you are worried about previously unseen realworld data 
                                 being larger than what is availiable at preprocessing.
+            num_processes   -- The number of processes to use to read the files concurrently
         #Returns (void)
                 '''
     unresolved = []
@@ -123,29 +141,27 @@ def resolveProfileMaxes(object_profiles, label_dir_pairs, padding_multiplier = 1
                 maxes[profile.name] = 0
     if(len(unresolved) == 0): return
     
+    tasks = []
+    names = [profile.name for profile in unresolved]
     for (label,data_dir) in label_dir_pairs:
         files, storeType = getFiles_StoreType(data_dir)
-        # files = glob.glob(data_dir+"*.h5")
-        files.sort()
-        
-         #Loop the files associated with the current label
-        for f in files:
-          
-            # #Get the HDF Store for the file
-            # store = pd.HDFStore(f)
-
-            # #Get the NumValues frame which lists the number of values for each entry
-            # try:
-            #     num_val_frame = store.get('/NumValues')
-            # except KeyError as e:
-            #     raise KeyError(str(e) + " " + f)
-            num_val_frame = getNumValFrame(f,storeType)
-            if(isinstance(num_val_frame, type(None))):
-                print("Skipping %r" % f)
-                continue
+        tasks += [(f, storeType, names) for f in files]
 
-            for profile in unresolved:
-                maxes[profile.name] = max(num_val_frame[profile.name].max(), maxes[profile.name])
+    #Each file is independent so they can be read concurrently
+    if(num_processes > 1):
+        pool = multiprocessing.Pool(num_processes)
+        try:
+            file_maxes = pool.map(_fileMaxes, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        file_maxes = [_fileMaxes(task) for task in tasks]
+
+    for file_max in file_maxes:
+        if(file_max == None): continue
+        for name in names:
+            maxes[name] = max(file_max[name], maxes[name])
     
     for profile in unresolved:
         profile.max_size = int(np.ceil(maxes[profile.name] * padding_multiplier))
@@ -175,13 +191,12 @@ def label_dir_pairs_args_decoder(*args, **kargs):
     args = tuple(out)
     return (args, kargs)
 
-def getFiles_StoreType(data_dir):
-    '''Gets a list of files from a directory in the filesystem and the type of data stored in it. Asserts that the directory is not empty.'''
-    data_dir = os.path.expandvars(data_dir)
-    if(not os.path.isdir(data_dir)):
-            raise IOError("Directory %r does not exist." % data_dir)
-    msgFiles = glob.glob(data_dir+"*.msg")
-    hdfFiles = glob.glob(data_dir+"*.h5")
+def _listFiles_StoreType(data_dir):
+    '''Helper Function - Lists the names of the pandas files in a directory in a single pass and finds their storeType'''
+    #Like glob, skip hidden files
+    names = [n for n in os.listdir(data_dir) if not n.startswith(".")]
+    msgFiles = [n for n in names if n.endswith(".msg")]
+    hdfFiles = [n for n in names if n.endswith(".h5")]
     if(len(msgFiles) == 0):
         files = hdfFiles
         storeType = "hdf5"
@@ -193,10 +208,20 @@ def getFiles_StoreType(data_dir):
                         filetype when generating pandas files, to avoid data repetition issues\
                         " % data_dir)
 
-    #files = glob.glob(data_dir+"*.h5")
     if(len(files) < 1):
         raise IOError("Cannot read from empty directory %r" % data_dir)
-    return (files, storeType)
+    return (tuple(files), storeType)
+
+def getFiles_StoreType(data_dir):
+    '''Gets a list of files from a directory in the filesystem and the type of data stored in it. Asserts that the directory is not empty.
+        Listings are cached until the directory is modified.'''
+    data_dir = os.path.expandvars(data_dir)
+    if(not os.path.isdir(data_dir)):
+            raise IOError("Directory %r does not exist." % data_dir)
+    names, storeType = _cached(_LISTDIR_CACHE, (os.path.abspath(data_dir), os.path.getmtime(data_dir)),
+                               LISTDIR_CACHE_SIZE, lambda: _listFiles_StoreType(data_dir))
+    #Give each caller its own list since they are often sorted in place
+    return ([os.path.join(data_dir, n) for n in names], storeType)
      
     
 def getSizeMetaData(filename, storeType, sizesDict=None, verbose=0):
@@ -206,9 +231,8 @@ def getSizeMetaData(filename, storeType, sizesDict=None, verbose=0):
     modtime = os.path.getmtime(filename)
     # print(sizesDict[filename][1],modtime)
     if(not filename in sizesDict or sizesDict[filename][1] != modtime):
-        num_val_frame = getNumValFrame(filename, storeType)
-        if(isinstance(num_val_frame,type(None))): return None
-        file_total_entries = len(num_val_frame.index)
+        file_total_entries = getNumValRows(filename, storeType)
+        if(isinstance(file_total_entries,type(None))): return None
         # print(file_total_entries)
         sizesDict[filename] = (file_total_entries,modtime)
         if (not os.path.isdir(filename)):
@@ -228,11 +252,50 @@ def getSizesDict(directory,verbose=0):
     
     
 
-def getNumValFrame(filename, storeType):
-    '''Finds the num_val_frame frame in a pandas file in either msg or h5 format'''
+#Tables read from pandas files, keyed by (abspath, modification time, storeType) so that edited files are reread
+_NUM_VAL_CACHE = OrderedDict()
+_MSGPACK_CACHE = OrderedDict()
+NUM_VAL_CACHE_SIZE = 256
+#Whole .msg files are large so only keep a couple of them around
+MSGPACK_CACHE_SIZE = 2
+#Directory listings, keyed by (abspath, modification time) so that added or removed files are seen
+_LISTDIR_CACHE = OrderedDict()
+LISTDIR_CACHE_SIZE = 256
+
+def _fileKey(filename, storeType):
+    '''Helper Function - Gets a key that identifies the current version of a file'''
+    filename = os.path.abspath(filename)
+    return (filename, os.path.getmtime(filename), storeType)
+
+def _cached(cache, key, maxsize, func):
+    '''Helper Function - Gets the value for key from an OrderedDict cache, computing it with func if it is
+        missing. Only the maxsize most recently used values are kept. None is never cached.'''
+    if(key in cache):
+        value = cache.pop(key)
+    else:
+        value = func()
+        if(value is None): return None
+        while(len(cache) >= maxsize):
+            cache.popitem(last=False)
+    cache[key] = value
+    return value
+
+def _readMsgpack(f):
+    '''Helper Function - Bulk reads all of the frames in a .msg file'''
+    print("Bulk reading .msg. Be patient, reading in slices not supported.")
+    sys.stdout.flush()
+    #Need to check for latin encodings due to weird pandas default
+    try:
+        frames = pd.read_msgpack(f)
+    except UnicodeDecodeError as e:
+        frames = pd.read_msgpack(f, encoding='latin-1')
+    return frames
+
+def _readNumValFrame(filename, storeType):
+    '''Helper Function - Reads the num_val_frame frame from a pandas file in either msg or h5 format'''
     if(storeType == "hdf5"):
         #Get the HDF Store for the file
-        store = pd.HDFStore(filename)
+        store = pd.HDFStore(filename, mode='r')
 
         #Get the NumValues frame which lists the number of values for each entry
         try:
@@ -241,168 +304,193 @@ def getNumValFrame(filename, storeType):
             print(str(e) + " " + filename +"Please check to see if the files is corrupted. \
              Run 'll' in the folder where the file is, if it is much smaller than the others then it is corrupted. \
              If it is corrupted then delete it.")
+            store.close()
             return None
         store.close()
         return num_val_frame
     elif(storeType == "msgpack"):
-        meta_frames =  msgpack_assertMeta(filename)
+        #Only the .meta file is read if it exists. Otherwise the bulk read needed to make it is cached,
+        #so that _getStore reuses it instead of reading the .msg file again.
+        frames = None
+        if(not os.path.exists(filename.replace(".msg", ".meta"))):
+            frames = _cached(_MSGPACK_CACHE, _fileKey(filename, storeType), MSGPACK_CACHE_SIZE,
+                             lambda: _readMsgpack(filename))
+        meta_frames =  msgpack_assertMeta(filename, frames)
         num_val_frame = meta_frames["NumValues"]
-        # frames = pd.read_msgpack(f)
-        # num_val_frame = frames["NumValues"]
     return num_val_frame
 
+def getNumValFrame(filename, storeType):
+    '''Finds the num_val_frame frame in a pandas file in either msg or h5 format. Results are cached
+        until the file is modified, so the returned frame should not be altered.'''
+    return _cached(_NUM_VAL_CACHE, _fileKey(filename, storeType), NUM_VAL_CACHE_SIZE,
+                   lambda: _readNumValFrame(filename, storeType))
+
+def getNumValRows(filename, storeType):
+    '''Finds the number of entries in a pandas file in either msg or h5 format. For tables in h5 files
+        this only reads the metadata of the NumValues table.'''
+    if(storeType == "hdf5"):
+        store = pd.HDFStore(filename, mode='r')
+        try:
+            nrows = store.get_storer('/NumValues').nrows
+        except KeyError as e:
+            #No NumValues table, the file is probably corrupted so skip it
+            print(str(e) + " " + filename)
+            return None
+        finally:
+            store.close()
+        #Fixed format frames do not keep a row count
+        if(nrows != None): return int(nrows)
+    num_val_frame = getNumValFrame(filename, storeType)
+    if(isinstance(num_val_frame, type(None))): return None
+    return len(num_val_frame.index)
+
 def _getStore(f, storeType):
     '''Helper Function - Gets the HDFStore or frames for the file and storeType'''
-    frames = None
+    store, frames = None, None
     if(storeType == "hdf5"):
-        store = pd.HDFStore(f)
+        store = pd.HDFStore(f, mode='r')
     elif(storeType == "msgpack"):
-        print("Bulk reading .msg. Be patient, reading in slices not supported.")
-        sys.stdout.flush()
-        #Need to check for latin encodings due to weird pandas default
-        try:
-            frames = pd.read_msgpack(f)
-        except UnicodeDecodeError as e:
-            frames = pd.read_msgpack(f, encoding='latin-1')
+        frames = _cached(_MSGPACK_CACHE, _fileKey(f, storeType), MSGPACK_CACHE_SIZE, lambda: _readMsgpack(f))
     return store,frames
 def _getFrame(store, storeType, key, select_start, select_stop,
-              samples_to_read, file_total_entries, frames):
-    '''Helper Function - gets frame from its store/msgpack'''
+              samples_to_read, file_total_entries, frames, columns=None):
+    '''Helper Function - gets frame from its store/msgpack, only reading the given columns if columns is not None'''
     if(storeType == "hdf5"):
         #If we are reading all the samples use get since it might be faster
         #TODO: check if it is actually faster
-        if(samples_to_read == file_total_entries):
+        if(samples_to_read == file_total_entries and columns == None):
             frame = store.get('/'+key)
+        elif(samples_to_read == file_total_entries):
+            frame = store.select('/'+key, columns=columns)
         else:
-            frame = store.select('/'+key, start=select_start, stop=select_stop)
+            frame = store.select('/'+key, start=select_start, stop=select_stop, columns=columns)
     elif(storeType == "msgpack"):
         frame = frames[key]
         frame = frame[select_start:select_stop]
+        if(columns != None): frame = frame[columns]
     return frame
 
-
-def entryGen(X,entryIndex):
-    currEntry = -1
-    start = 0
-    for i, x in enumerate(X):
-        # print(x,x[entryIndex])
-        entry = x[entryIndex]
-        # print(entry)
-        if (entry != currEntry):
-            if (entry < currEntry):
-                raise ValueError("Dataframe 'Entry' column not sorted")
-            if (start != i): yield int(currEntry), X[start: i]
-            start = i
-            currEntry = entry
-    yield int(currEntry), X[start: len(X)]
-    
-
-
-def _groupsByEntry(f, storeType, samples_per_label, samples_to_read, file_total_entries, num_val_frame,file_start_read,object_profiles):
-    '''Helper Function - produces dict keyed by object type and filled with groupBy objects w.r.t Entry'''
+def _profileColumns(profile, observ_types):
+    '''Helper Function - Gets the columns of a table that are needed to preprocess it with profile'''
+    #A query can reference any column so read all of them
+    if(profile.query != None): return None
+    addColumns = profile.addColumns if profile.addColumns != None else {}
+    columns = ["Entry"] + [o for o in observ_types if not o in addColumns]
+    for c in (profile.pre_sort_columns if profile.pre_sort_columns != None else []):
+        if(not c in columns and not c in ["shuffle", "random", None]):
+            columns.append(c)
+    return columns
+
+def _entryOffsets(num_vals):
+    '''Helper Function - Gets the row where each entry starts in a table from the number of rows in each entry.
+        The rows of entry i are [offsets[i], offsets[i+1])'''
+    return np.concatenate(([0], np.cumsum(np.asarray(num_vals, dtype=np.int64))))
+
+def _tablesByProfile(f, storeType, samples_to_read, file_total_entries, num_val_frame,file_start_read,profile_columns):
+    '''Helper Function - produces dict keyed by object type and filled with (frame, offsets) where offsets
+        gives the rows in frame at which each entry starts. profile_columns is a list of tuples
+        (profile, columns) where columns are the columns to read for that profile (None for all of them).'''
     store, frames = _getStore(f, storeType)
-
-    #Get information about how many rows there are for each entry for the rows we want to skip and read
-    skip_val_frame = num_val_frame[:file_start_read]
-    num_val_frame = num_val_frame[file_start_read : file_start_read+samples_to_read]
-
-
-    groupBys = {}
-    colDict = {}
-    #Loop over every profile and read the corresponding tables in the pandas file
-    for profile in object_profiles:
-        key = profile.name         
-        #TODO: KLUDGE
-        _key = key if(not key == "EventChars") else "MissingET" 
-        #Where to start reading the table based on the sum of the selection start 
-        select_start = int(skip_val_frame[_key].sum())
-        select_stop = select_start + int(num_val_frame[_key].sum())
-
-        frame = _getFrame(store, storeType, key, select_start, select_stop,
-                          samples_to_read, file_total_entries,frames)
-        columns = list(frame.columns)
-        entryIndex = columns.index("Entry")
-        
-        #Convert to numpy array
-        X = frame.values
-        colDict[key] = columns
-        
-        #Group by Entry
-        # groupBys[key] = frame.groupby(["Entry"], group_keys=True)
-        groupBys[key] = {entry:x for entry,x  in entryGen(X,entryIndex)}#frame.groupby(["Entry"], group_keys=True)
-        # print(key,groupBys[key].keys())
-    return groupBys,colDict, store
-
-def _applyParticleCuts(x, columns, profile, vecsize, observ_types):
-    '''Helper Function - presorts, applies queries, adds columns, and makes cuts'''
-    # if (profile.query != None):
-    #     df = df.query(profile.query)
-    # x = df.values
-    # print(type(x))
-    if(profile.pre_sort_columns != None):
-        # Find sort_locs
-        sort_locs = None
-        assert not isinstance(profile.pre_sort_columns, str), "profile.pre_sort_columns improperly stored"
-        if (True in [c in profile.pre_sort_columns for c in ["shuffle", "random"]]):
-            np.random.shuffle(x)
-        elif (not None in profile.pre_sort_columns):
-            assert not False in [isinstance(s, str) or isinstance(s, unicode) for s in profile.pre_sort_columns], \
-                "Type should be string got %s" % (",".join([str(type(s)) for s in profile.pre_sort_columns]))
-            sort_locs = [columns.index(s) for s in profile.pre_sort_columns]
-            # print(df.columns, sort_locs, )
-        # Sort
-        x = _sortByLocs(x, sort_locs, profile.pre_sort_ascending)#, observ_types)
-        # x = _sortByColumns(x, profile.pre_sort_columns, profile.pre_sort_ascending, observ_types)
-        # df = df.sort(profile.pre_sort_columns, ascending=profile.pre_sort_ascending)
+    try:
+        #Get information about how many rows there are for each entry for the rows we want to skip and read
+        skip_val_frame = num_val_frame[:file_start_read]
+        num_val_frame = num_val_frame[file_start_read : file_start_read+samples_to_read]
+
+        #Work out which rows of each table to read before touching the tables
+        selections = []
+        for profile, columns in profile_columns:
+            key = profile.name
+            #TODO: KLUDGE
+            _key = key if(not key == "EventChars") else "MissingET" 
+            #Where to start reading the table based on the sum of the selection start 
+            select_start = int(skip_val_frame[_key].sum())
+            select_stop = select_start + int(num_val_frame[_key].sum())
+            selections.append((key, select_start, select_stop, columns, _entryOffsets(num_val_frame[_key].values)))
+
+        tables = {}
+        #Read only the rows and columns that we need from each table
+        for key, select_start, select_stop, columns, offsets in selections:
+            frame = _getFrame(store, storeType, key, select_start, select_stop,
+                              samples_to_read, file_total_entries,frames, columns=columns)
+            assert offsets[-1] == len(frame.index), "NumValues for %r does not match table length in %r" % (key, f)
+            tables[key] = (frame, offsets)
+    except Exception:
+        #The caller only closes the store when the tables are read successfully
+        if(store != None): store.close()
+        raise
+    return tables, store
+
+def _queryFrame(frame, offsets, profile):
+    '''Helper Function - applies profile.query to a whole table at once and returns the selected rows along
+        with the recomputed offsets of each entry. Entries that lose all of their rows are kept empty.'''
+    if(profile.query == None):
+        return frame, offsets
+    mask = np.asarray(frame.eval(profile.query, engine=QUERY_ENGINE), dtype=bool)
+    entry_locs = np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+    counts = np.bincount(entry_locs[mask], minlength=len(offsets)-1)
+    return frame[mask], _entryOffsets(counts)
+
+def _preSortFrame(frame, profile, rng=np.random):
+    '''Helper Function - presorts (or shuffles with rng) the rows within each entry for a whole table at once'''
+    assert not isinstance(profile.pre_sort_columns, str), "profile.pre_sort_columns improperly stored"
+    if(profile.pre_sort_columns == None or None in profile.pre_sort_columns):
+        return frame
+    if (True in [c in profile.pre_sort_columns for c in ["shuffle", "random"]]):
+        #Shuffle every row and then put the entries back in order with a stable sort
+        frame = frame.iloc[rng.permutation(len(frame.index))]
+        return frame.sort_values(by="Entry", kind='mergesort')
+    assert not False in [isinstance(s, str) or isinstance(s, unicode) for s in profile.pre_sort_columns], \
+        "Type should be string got %s" % (",".join([str(type(s)) for s in profile.pre_sort_columns]))
+    ascending = [profile.pre_sort_ascending == True] * len(profile.pre_sort_columns)
+    return frame.sort_values(by=["Entry"] + profile.pre_sort_columns, ascending=[True] + ascending, kind='mergesort')
     
-    # x = df.values
-    # Make cut, preserving only profile.max_size of top of table
-    x = x[:profile.max_size]
-    # Only use observable columns
-    if(observ_types != None):
-        x = np.take(x,[columns.index(o) for o in observ_types],axis=1)
-    # print(x.shape)
-    return x
-    
-def _addColumns(x,profile,observ_types):
-    '''Helpher Function - adds columns of constants to the data'''
-    for i, o in enumerate(observ_types):
-        if (profile.addColumns != None and o in profile.addColumns):
-            x = np.insert(x, i, profile.addColumns[o], axis=1)
-    return x
+def _addColumns(frame,profile):
+    '''Helpher Function - adds columns of constants to the whole table'''
+    if (profile.addColumns != None):
+        frame = frame.assign(**profile.addColumns)
+    return frame
     
-def _sortByLocs(x,sort_locs,sort_ascending):#, observ_types,):
-    # print(sort_locs)
-    # print sort_locs, type(x)
-    if (sort_locs != None):
-        for loc in reversed(sort_locs):
-            if (sort_ascending == True):
-                x = x[x[:, loc].argsort()]
-            else:
-                x = x[x[:, loc].argsort()[::-1]]
-    return x
-
-def _padAndSort(x, profile,vecsize, observ_types):
-    '''Helper Function - pads the data and sorts it'''
-    if(isinstance(x, type(None))):
-        #If a DataFrame does not exist for this entry then just inject zeros 
-        x = np.array(np.zeros((profile.max_size, vecsize)))
-    else:
-        #Find sort_locs
-        sort_locs = None
-        assert not isinstance(profile.sort_columns, str), "profile.sort_columns improperly stored"
-        if(profile.sort_columns != None):
-            if(True in [c in profile.sort_columns for c in ["shuffle", "random"]]):
-                np.random.shuffle(x)
-            elif (not None in profile.sort_columns):
-                assert not False in [isinstance(s, str) or isinstance(s, unicode) for s in profile.sort_columns], \
-                    "Type should be string got %s" % (",".join([str(type(s)) for s in profile.sort_columns]))
-                sort_locs = [observ_types.index(s) for s in profile.sort_columns]
-        #Sort
-        x = _sortByLocs(x, sort_locs, profile.sort_ascending)#, observ_types)
-        #pad the array
-        x = np.append(x ,np.array(np.zeros((profile.max_size - len(x), vecsize))), axis=0)
-    return x    
+def _sortLocs(sort_columns, observ_types):
+    '''Helper Function - Gets the locations of sort_columns in observ_types and whether or not to shuffle instead'''
+    assert not isinstance(sort_columns, str), "sort_columns improperly stored"
+    if(sort_columns == None or None in sort_columns):
+        return None, False
+    if(True in [c in sort_columns for c in ["shuffle", "random"]]):
+        return None, True
+    assert not False in [isinstance(s, str) or isinstance(s, unicode) for s in sort_columns], \
+        "Type should be string got %s" % (",".join([str(type(s)) for s in sort_columns]))
+    return [observ_types.index(s) for s in sort_columns], False
+
+def _cutSortBlock(vals, offsets, profile, observ_types, out, sort=True, rng=np.random):
+    '''Helper Function - cuts each entry of vals to profile.max_size rows, sorts them by profile.sort_columns
+        (or shuffles them with rng) and writes them into the zeroed array out.
+        Returns the number of (unpadded) rows kept for each entry'''
+    sort_locs, shuffle = _sortLocs(profile.sort_columns, observ_types) if sort else (None, False)
+    sort_locs = np.array(sort_locs if sort_locs != None else [], dtype=np.int64)
+    counts = pad_sort_block(vals, offsets, profile.max_size, sort_locs, profile.sort_ascending == True, out)
+    if(shuffle):
+        for x, n in zip(out, counts):
+            rng.shuffle(x[:n])
+    return counts
+
+def _fillBlock(frame, offsets, profile, observ_types, sort=True, out=None, dtype='float32', rng=np.random):
+    '''Helper Function - presorts, cuts, sorts and pads every entry in a table into one preallocated array.
+        Writes into out if it is given, otherwise into a new array of the given dtype.
+        Returns the array and the number of (unpadded) rows kept for each entry'''
+    frame, offsets = _queryFrame(frame, offsets, profile)
+    frame = _preSortFrame(frame, profile, rng=rng)
+    if(out is None):
+        out = np.zeros((len(offsets)-1, profile.max_size, len(observ_types)), dtype=dtype)
+    vals = np.ascontiguousarray(frame[observ_types].values, dtype=out.dtype)
+    counts = _cutSortBlock(vals, offsets, profile, observ_types, out, sort=sort, rng=rng)
+    return out, counts
+
+def _joinBlocks(blocks, counts):
+    '''Helper Function - joins the unpadded rows of each entry across blocks, keeping the order of the blocks.
+        Returns the joined rows and the offsets of each entry'''
+    joined = np.concatenate(blocks, axis=1)
+    mask = np.concatenate([np.arange(b.shape[1]) < c[:, None] for b, c in zip(blocks, counts)], axis=1)
+    return joined[mask], _entryOffsets(np.sum(counts, axis=0))
 
 def _gen_label_vecs(label_dir_pairs, num_labels):
     label_vecs = {}
@@ -412,18 +500,25 @@ def _gen_label_vecs(label_dir_pairs, num_labels):
         label_vecs[label] = arr
     return label_vecs
 
-def _initializeArrays(single_list, label_dir_pairs, num_object_profiles, samples_per_label, num_labels, maxJets=MAX_NUM_JETS):
-    '''Helper Function - Generates the initial data structures for the X (data) and Y (target)'''
+def _initializeArrays(single_list, label_dir_pairs, num_object_profiles, samples_per_label, num_labels, maxJets=MAX_NUM_JETS,
+                      max_sizes=None, vecsize=None, dtype='float32'):
+    '''Helper Function - Generates the initial data structures for the X (data) and Y (target). If max_sizes
+        (the max_size of each ObjectProfile) and vecsize are given X is preallocated as zeroed arrays of dtype'''
     
-        
-    if(single_list):
-        X_train = [None] * (samples_per_label * num_labels)
+    total = samples_per_label * num_labels
+    if(max_sizes != None and vecsize != None):
+        if(single_list):
+            X_train = np.zeros((total, sum(max_sizes), vecsize), dtype=dtype)
+        else:
+            X_train = [np.zeros((total, max_size, vecsize), dtype=dtype) for max_size in max_sizes]
+    elif(single_list):
+        X_train = [None] * (total)
         #global_profile = ObjectProfile("list", max_size="")
     else:
         X_train = [None] * (num_object_profiles)
         #Prefill the arrays so that we don't waste time resizing lists
         for index in range(num_object_profiles):
-            X_train[index] = [None] * (samples_per_label * num_labels)
+            X_train[index] = [None] * (total)
             
     y_train = [None] * (samples_per_label * num_labels)
     jets = [None] * (samples_per_label * num_labels)
@@ -449,16 +544,81 @@ def _check_Object_Profiles(object_profiles, observ_types):
 def _check_inputs(label_dir_pairs, observ_types):
     '''Helper Function - Makes sure that label_dir_pairs, and observ_types are correctly formatted'''
     labels = [x[0] for x in label_dir_pairs]
-    duplicates = list(set([x for x in labels if labels.count(x) > 1]))
+    duplicates = [label for label, count in Counter(labels).items() if count > 1]
     if(len(duplicates) != 0):
         raise ValueError("Cannot have duplicate labels %r" % duplicates)
     if("Entry" in observ_types):
         raise ValueError("Using Entry in observ_types can result in skewed training results. Just don't.")
     
 
+
+def _shuffleArrays(arrays, indices):
+    '''Helper Function - reorders the first axis of each array by indices. Each shuffled array is written into
+        the buffer freed by a previous array of the same shape and dtype when there is one.'''
+    spare = {}
+    out = []
+    for arr in arrays:
+        key = (arr.shape, arr.dtype)
+        buf = spare.pop(key) if key in spare else np.empty_like(arr)
+        np.take(arr, indices, axis=0, out=buf)
+        out.append(buf)
+        spare[key] = arr
+    return out
+
+def _processFile(task, outs=None):
+    '''Helper Function - reads and preprocesses a range of entries from one file. task is a tuple
+        (f, storeType, file_start_read, samples_to_read, file_total_entries, object_profiles, observ_types,
+        single_list, list_profile, dtype, seed). The X blocks are written into outs if it is given.
+        Shuffles are drawn from a RandomState seeded with seed, so the result does not depend on which process
+        reads the file. Returns the X blocks and the jet and EventChars blocks.'''
+    (f, storeType, file_start_read, samples_to_read, file_total_entries,
+        object_profiles, observ_types, single_list, list_profile, dtype, seed) = task
+    rng = np.random.RandomState(seed)
+    vecsize = len(observ_types)
+    if(outs == None):
+        outs = [np.zeros((samples_to_read, p.max_size, vecsize), dtype=dtype)
+                    for p in ([list_profile] if single_list else object_profiles)]
+
+    num_val_frame = getNumValFrame(f, storeType)
+    assert file_total_entries == len(num_val_frame.index)
+    
+    #Grab data from tables and find the rows belonging to each entry
+    profile_columns = [(p, _profileColumns(p, observ_types)) for p in object_profiles] + \
+                      [(JET_PROFILE, None), (EVENT_CHARS_PROFILE, None)]
+    tables,store = _tablesByProfile(f, storeType, samples_to_read, file_total_entries,
+                                            num_val_frame, file_start_read, profile_columns)
+    try:
+        #Apply Cuts for particles, each profile is cut and padded into one block for the whole file
+        blocks, counts = [], []
+        for index, profile in enumerate(object_profiles):
+            frame, offsets = tables[profile.name]
+            out = outs[index] if not single_list else \
+                    np.zeros((samples_to_read, profile.max_size, vecsize), dtype=dtype)
+            block, count = _fillBlock(_addColumns(frame, profile), offsets, profile, observ_types,
+                                      sort=not single_list, out=out, rng=rng)
+            blocks.append(block)
+            counts.append(count)
+
+        if(single_list):
+            #join the data, but ommit the jet and event char collections
+            vals, offsets = _joinBlocks(blocks, counts)
+            _cutSortBlock(vals, offsets, list_profile, observ_types, outs[0], rng=rng)
+
+        other_blocks = []
+        for profile in [JET_PROFILE, EVENT_CHARS_PROFILE]:
+            frame, offsets = tables[profile.name]
+            obervs = [x for x in frame.columns if x != "Entry"]
+            block, _ = _fillBlock(frame, offsets, profile, obervs, dtype=dtype)
+            other_blocks.append(block)
+    finally:
+        #Close the store even if the tables are malformed, so that the file can be reopened for writing
+        if(storeType == "hdf5"):
+            store.close()
+    return outs, other_blocks[0], other_blocks[1]
         
 def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_label, object_profiles, observ_types,
-                                         single_list=False, sort_columns=None, sort_ascending=True,verbose=1):
+                                         single_list=False, sort_columns=None, sort_ascending=True,verbose=1, dtype='float32',
+                                         num_processes=1, observables_first=False):
     '''Gets training data from folders of pandas tables
     
         #Arguements:
@@ -472,6 +632,10 @@ def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_labe
             single_list -- If True all object types are joined into a single list.
             sort_columns -- If single_list the columns to sort by.
             sort_ascending -- If True sort in ascending order, false decending  
+            dtype -- The numpy dtype of the returned data (i.e 'float32', 'float16', 'float64')
+            num_processes -- The number of processes to use to read and preprocess files concurrently
+            observables_first -- If True the X arrays are laid out as (samples, observables, values) instead of
+                                (samples, values, observables) so that each observable of a sample is contiguous.
         #Returns:
             Training data with its correspoinding labels
             (X_train, Y_train)
@@ -481,18 +645,20 @@ def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_labe
     #Make sure that all the profile are proper objects and have resolved max_sizes
     object_profiles = _check_Object_Profiles(object_profiles,observ_types)
 
-    non_add_observtypes = [o for o in observ_types if not o in set.union(*[set(p.addColumns) for p in object_profiles])]
-    
     vecsize = len(observ_types)
     num_labels = len(label_dir_pairs)
     
-    #Build vectors in the form [1,0,0], [0,1,0], [0, 0, 1] corresponding to each label
-    label_vecs = _gen_label_vecs(label_dir_pairs,num_labels)
-    X_train, y_train, jets, eventChars = _initializeArrays(single_list, label_dir_pairs, len(object_profiles), samples_per_label, num_labels)
+    X_train, y_train, jets, eventChars = _initializeArrays(single_list, label_dir_pairs, len(object_profiles), samples_per_label, num_labels,
+                                                          max_sizes=[p.max_size for p in object_profiles], vecsize=vecsize, dtype=dtype)
+    list_profile = ObjectProfile("single_list",
+                                 sum([profile.max_size for profile in object_profiles]),
+                                 sort_columns=sort_columns,
+                                 sort_ascending=sort_ascending)
     X_train_index = 0
+    if(verbose >= 1): print("Values/Sample from: %r" % {p.name: p.max_size for p in object_profiles})
     
-    #Loop over label dir pairs and get the file list for each directory
-    y_train_start = 0
+    #Loop over label dir pairs and work out which entries to read from each file
+    tasks = []
     for (label,data_dir) in label_dir_pairs:
         files, storeType = getFiles_StoreType(data_dir)
         files.sort()
@@ -502,7 +668,7 @@ def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_labe
         sizesDict = get_sizes_meta_dict(data_dir)
          #Loop the files associated with the current label
         for f in files:
-            file_total_entries = size_from_meta(f, storeType, sizesDict=sizesDict)#len(num_val_frame.index)
+            file_total_entries = getSizeMetaData(f, storeType, sizesDict=sizesDict)
             if (file_total_entries == None):
                 print("Skipping %r" % f)
                 continue
@@ -513,8 +679,6 @@ def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_labe
                 location += file_total_entries
                 continue
 
-            num_val_frame = getNumValFrame(f, storeType)
-            assert file_total_entries == len(num_val_frame.index)
             #Determine what row to start reading the num_val table which contains
             #information about how many rows there are for each entry
             file_start_read = start-location if start > location else 0
@@ -524,82 +688,10 @@ def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_labe
             assert samples_to_read >= 0
             
             if(verbose >= 1): print("Reading %r samples from %r:" % (samples_to_read,f))
-            
-            #Grab data from tables and group by 'Entry #'
-            groupBys,colDict,store = _groupsByEntry(f, storeType, samples_per_label, samples_to_read, file_total_entries,
-                                                    num_val_frame, file_start_read, object_profiles + [JET_PROFILE, EVENT_CHARS_PROFILE])
-                
-            if(verbose >= 1): print("Values/Sample from: %r" % {p.name: p.max_size for p in object_profiles})
-            
-            cut_tables = [None] * (len(object_profiles)+2)
-            last_time = time.clock()-1.0
-            prev_entry = file_start_read
-            for entry in range(file_start_read, file_start_read+samples_to_read):
-                #Make a pretty progress bar in the terminal
-                if(verbose >= 1):      
-                    c = time.clock() 
-                    if(c > last_time + .25):
-                        percent = float(entry-file_start_read)/float(samples_to_read)
-                        sys.stdout.write('\r')
-                        sys.stdout.write("[%-20s] %r/%r  %r(Entry/sec)" % ('='*int(20*percent), entry, int(samples_to_read), 4 * (entry-prev_entry)))
-                        sys.stdout.flush()
-                        last_time = c
-                        prev_entry = entry
-                
-                jet_indx = len(object_profiles)
-                chars_indx = len(object_profiles)+1 
-                #Apply Cuts for particles
-                for index, profile in enumerate(object_profiles + [JET_PROFILE, EVENT_CHARS_PROFILE]) :
-                        #print(groupBys.keys())
-                        groups = groupBys[profile.name]
-                        columns = colDict[profile.name]
-                        obtypes = non_add_observtypes if index < jet_indx else [x for x in colDict[profile.name] if x != "Entry"]
-                        # print(entry,entry in groups)
-                        if(entry in groups):
-                            x = _applyParticleCuts(groups[entry], columns, profile, vecsize, obtypes)
-                            # x = _applyCuts(groups.get_group(entry), profile, vecsize, non_add_observtypes)
-                            cut_tables[index] = _addColumns(x, profile, observ_types)
-                        else:
-                            cut_tables[index] = None
-                
-                if(single_list):
-                    #joint the data, but ommit the jet and event char collections
-                    x = np.concatenate([c for c in cut_tables[:-2] if c != None], axis=0)
-                    list_profile = ObjectProfile("single_list",
-                                                sum([profile.max_size for profile in object_profiles]),
-                                                sort_columns=sort_columns,
-                                                sort_ascending=sort_ascending)    
-                                                    
-                    x  = _padAndSort(x,list_profile,vecsize,observ_types)
-                    X_train[X_train_index + entry - file_start_read] = x
-                else:
-                    for index, profile in enumerate(object_profiles):
-                        arr = X_train[index]
-                        c = cut_tables[index]
-                        x  = _padAndSort(c,profile, vecsize,observ_types)
-                        arr[X_train_index + entry - file_start_read] = x
-                        
-                jet_df = cut_tables[jet_indx]
-                jet_obervs = [x for x in colDict['Jet'] if x != "Entry"]
-                # print(_padAndSort(jet_df,JETS_PROFILE,len(JET_OUTPUT_OBSERVS),JET_OUTPUT_OBSERVS))
-                # print("JET_DF",jet_df)
-                jets[X_train_index + entry - file_start_read] = _padAndSort(jet_df, JET_PROFILE, len(jet_obervs), jet_obervs)
-
-                chars_obervs = [x for x in colDict['EventChars'] if x != "Entry"]
-                chars_df = cut_tables[chars_indx]
-                eventChars[X_train_index + entry - file_start_read] = _padAndSort(chars_df, EVENT_CHARS_PROFILE,len(chars_obervs), chars_obervs)
-
-                
-                        
-                
-                
+            tasks.append(((f, storeType, file_start_read, samples_to_read, file_total_entries,
+                           object_profiles, observ_types, single_list, list_profile, dtype), X_train_index))
             
             X_train_index += samples_to_read
-            
-            #Free this (probably not necessary)
-            num_val_frame = None
-            if(storeType == "hdf5"):
-                store.close()
             location     += file_total_entries
             samples_read += samples_to_read
             if(verbose >= 1): print("*Read %r Samples of %r in range(%r, %r)" % (samples_read, samples_per_label, start, samples_per_label+start))
@@ -609,29 +701,59 @@ def preprocessFromPandas_label_dir_pairs(label_dir_pairs,start, samples_per_labe
                 break
         if(samples_read != samples_per_label):
             raise IOError("Not enough data in %r to read in range(%r, %r)" % (data_dir, start, samples_per_label+start))
-        
-        #Generate the target data as vectors like [1,0,0], [0,1,0], [0,0,1]
-        for i in range(samples_per_label):
-            y_train[y_train_start+i] = label_vecs[label]
-        y_train_start += samples_per_label
     
-    #Turn everything into numpy arrays and shuffle them just in case.
-    #Although, we probably don't need to shuffle since keras shuffles by default.
-    y_train = np.array(y_train)
+    #Generate the target data as vectors like [1,0,0], [0,1,0], [0,0,1], the labels are read in order
+    y_train = np.repeat(np.eye(num_labels, dtype=dtype), samples_per_label, axis=0)
     
+    #Shuffle everything just in case.
+    #Although, we probably don't need to shuffle since keras shuffles by default.
     indices = np.arange(len(y_train))
     np.random.shuffle(indices)
+
+    #Seed each file's shuffles from np.random, so that num_processes does not change the output
+    seeds = np.random.randint(2**31 - 1, size=len(tasks))
+    tasks = [(task + (int(seed),), arr_start) for (task, arr_start), seed in zip(tasks, seeds)]
+
+    #Read and preprocess the files, each one fills a contiguous range of samples
+    spans = [(arr_start, arr_start + task[3]) for task, arr_start in tasks]
+    outs = [[X_train[a:b]] if single_list else [x[a:b] for x in X_train] for a, b in spans]
+    pool = multiprocessing.Pool(num_processes) if num_processes > 1 else None
+    try:
+        if(pool == None):
+            #Write straight into X_train
+            results = (_processFile(task, outs=o) for (task, _), o in zip(tasks, outs))
+        else:
+            results = pool.imap(_processFile, [task for task, _ in tasks])
+        for (arr_start, arr_stop), o, (task_outs, jets_block, event_block) in zip(spans, outs, results):
+            if(pool != None):
+                for out, task_out in zip(o, task_outs):
+                    out[:] = task_out
+            if(isinstance(jets, list)):
+                #The number of Jet and EventChars columns is only known once their tables are read
+                jets = np.zeros((len(jets),) + jets_block.shape[1:], dtype=jets_block.dtype)
+                eventChars = np.zeros((len(eventChars),) + event_block.shape[1:], dtype=event_block.dtype)
+            jets[arr_start:arr_stop] = jets_block
+            eventChars[arr_start:arr_stop] = event_block
+    finally:
+        if(pool != None):
+            pool.close()
+            pool.join()
+    
+    #Apply the shuffle drawn before reading
     if(single_list):
-        X_train = np.array(X_train)[indices]
+        X_train, y_train = _shuffleArrays([X_train, y_train], indices)
     else:
-        for index in range(len(X_train)):
-            X_train[index] = np.array(X_train[index])[indices]
-
-    y_train = y_train[indices]
+        shuffled = _shuffleArrays(X_train + [y_train], indices)
+        X_train, y_train = shuffled[:-1], shuffled[-1]
+    if(observables_first):
+        if(single_list):
+            X_train = np.ascontiguousarray(X_train.transpose(0, 2, 1))
+        else:
+            X_train = [np.ascontiguousarray(x.transpose(0, 2, 1)) for x in X_train]
     return X_train, y_train, jets, eventChars
     
 
-def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir_pairs, observ_types, single_list=False, sort_columns=None, sort_ascending=True, batch_size=100, megabytes=500, data_keys=["X","Y"],dp_data_keys=None, verbose=1):
+def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir_pairs, observ_types, single_list=False, sort_columns=None, sort_ascending=True, batch_size=100, megabytes=500, data_keys=["X","Y"],dp_data_keys=None, dtype='float32', verbose=1):
     '''Creates a set of DataProcedures that return generators and their corresponding lengths. Each generator consists of a list DataProcedures that preprocess data
         from a set of label_dir_pairs in a given range. The size of the archived files for each DP is set by 'megabytes' so that each one is not too big. Each generator
         reads a number of samples per label type set by 'splits' and 'length', and feeds data in batches of 'batch_size' into training.
@@ -650,6 +772,7 @@ def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir
             batch_size -- How many samples to feed into training at a time. 
             megabytes -- Determines how large in MB a DataProcedure archive should be. A smaller number means less data in memory at a time as each generator is used, but shorter more frequent
                         disk reads. 
+            dtype -- The numpy dtype of the preprocessed data (i.e 'float32', 'float16', 'float64')
             verbose -- Determines whether or not information is printed out as the generators are formed and as they are used. (TODO: the implementation of this might need some work, the specifics
                         of how this information is passed along the the DPs and their dependant functions might not be implemented correctly at the moment, leading to printouts even if verbose=0)
         #Returns (all_dps, all_datasets)
@@ -661,7 +784,7 @@ def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir
     assert isinstance(object_profiles, list)
     assert isinstance(label_dir_pairs, list)
     assert isinstance(observ_types, list)
-    stride = strideFromTargetSize(object_profiles, label_dir_pairs, observ_types, megabytes=megabytes)
+    stride = strideFromTargetSize(object_profiles, label_dir_pairs, observ_types, megabytes=megabytes, dtype=dtype)
     SNs = start_num_fromSplits(splits, length)
     all_dps = []
     all_datasets = []
@@ -677,8 +800,9 @@ def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir
                                         sort_columns=sort_columns,
                                         sort_ascending=sort_ascending,
                                         verbose=verbose,
-                                        data_keys=dp_data_keys)
-        gen_DP = DataProcedure(archive_dir, False, gen_from_data, [dps, batch_size], {'threading':False, 'verbose':verbose}, data_keys=data_keys)
+                                        data_keys=dp_data_keys,
+                                        dtype=dtype)
+        gen_DP = DataProcedure(archive_dir, False, gen_from_data, [dps, batch_size], {'verbose':verbose}, data_keys=data_keys)
         num_samples = len(label_dir_pairs)*s[1]
         all_datasets += [(gen_DP, num_samples)]
         all_dps += dps
@@ -691,10 +815,12 @@ def getGensDefaultFormat(archive_dir, splits, length, object_profiles, label_dir
        
             
 
-def strideFromTargetSize(object_profiles, num_labels, observ_types, megabytes=100):
-    '''Computes how large a stride is required to get DPs with archives of size megabytes'''
+def strideFromTargetSize(object_profiles, num_labels, observ_types, megabytes=100, dtype='float32'):
+    '''Computes how large a stride is required to get DPs with archives of size megabytes when storing
+        values of the given dtype'''
     if(isinstance(num_labels, list)): num_labels = len(num_labels)
-    megabytes_per_sample = sum(o.max_size for o in object_profiles) * len(observ_types) * 24.0 / (1000.0 * 1000.0)
+    bytes_per_value = np.dtype(dtype).itemsize * 3.0
+    megabytes_per_sample = sum(o.max_size for o in object_profiles) * len(observ_types) * bytes_per_value / (1000.0 * 1000.0)
     return int(megabytes/megabytes_per_sample)
 
 def maxMutualLength(label_dir_pairs, object_profiles):
@@ -715,49 +841,21 @@ def maxMutualLength(label_dir_pairs, object_profiles):
          #Loop the files associated with the current label
         
         for f in files:
-            #Get the HDF Store for the file
-            if(storeType == "hdf5"):
-                #Get the HDF Store for the file
-                store = pd.HDFStore(f)
-
-                #Get the NumValues frame which lists the number of values for each entry
-
-                if(keys != None and set(keys).issubset(set(store.keys())) == False):
+            if(storeType == "hdf5" and keys != None):
+                #Check that the file has the tables we need without reading them
+                store = pd.HDFStore(f, mode='r')
+                found_keys = store.keys()
+                store.close()
+                if(set(keys).issubset(set(found_keys)) == False):
                     print('File: ' + f + ' may be corrupted:' + os.linesep + 
                                     'Requested keys: ' + str(keys) + os.linesep + 
-                                    'But found keys: ' + str(store.keys()) )
+                                    'But found keys: ' + str(found_keys) )
                     print('Skipping %r' % f)
                     continue
-                
-                try:
-                    num_val_frame = store.get('/NumValues')
-                except KeyError as e:
-                    raise KeyError(str(e) + " " + f)
-            elif(storeType == "msgpack"):
-                print("Bulk reading .msg. Be patient, reading in slices not supported.")
-                sys.stdout.flush()
-
-                #Need to check for latin encodings due to weird pandas default
-                try:
-                    frames = pd.read_msgpack(f)
-                except UnicodeDecodeError as e:
-                    frames = pd.read_msgpack(f, encoding='latin-1')
-                num_val_frame = frames["NumValues"]
-                    # store = pd.HDFStore(f)
-                    # #print(keys)
-                    # #print(store.keys())
-                    # #print(set(keys).issubset(set(store.keys())))
-                    # if(keys != None and set(keys).issubset(set(store.keys())) == False):
-                    #     raise KeyError('File: ' + f + ' may be corrupted:' + os.linesep + 
-                    #                     'Requested keys: ' + str(keys) + os.linesep + 
-                    #                     'But found keys: ' + str(store.keys()) )
-                    
-                    # #Get file_total_entries
-                    # try:
-                    #     num_val_frame = store.get('/NumValues')
-                    # except KeyError as e:
-                    #     raise KeyError(str(e) + " " + f)
-            file_total_entries = len(num_val_frame.index)
+            file_total_entries = getNumValRows(f, storeType)
+            if(isinstance(file_total_entries, type(None))):
+                print('Skipping %r' % f)
+                continue
             label_totals[label] += file_total_entries
     #print(label_totals)
     return min(label_totals.values())
@@ -765,34 +863,27 @@ def maxMutualLength(label_dir_pairs, object_profiles):
 def start_num_fromSplits(splits, length):
     '''Takes in a tuple of splits and a length and returns a list of tuples with the starts and number of
         samples for each split'''
-    if(True in [x < 0.0 for x in splits]):
+    if((np.asarray(splits) < 0.0).any()):
         raise ValueError("Splits cannot be negative %r" % str(splits)) 
-    are_static_vals = [(True if int(x) > 0 else False) for x in splits]
-    if(True in are_static_vals):
-        ratios =  [s for s, a in zip(splits, are_static_vals) if(not a)]
-        static_vals =  [s for s, a in zip(splits, are_static_vals) if(a)]
-        s = sum(static_vals) 
-        if(s > length):
-            raise ValueError("Static values have sum %r exceeding given length %r" %(s,length)) 
-        length -= s
-    else:
-        ratios = splits
-    
-    if(len(ratios) > 0 and np.isclose(sum(ratios),1.0) == False):
-        raise ValueError("Sum of splits %r must equal 1.0" % sum(ratios))
+    splits = np.asarray(splits, dtype=np.float64)
+    #Integer entries (those >= 1) are static numbers of samples, the rest are ratios of what is left
+    are_static_vals = splits >= 1.0
+    s = float(splits[are_static_vals].sum())
+    if(s > length):
+        raise ValueError("Static values have sum %r exceeding given length %r" %(s,length)) 
+    length -= s
     
+    ratios = splits[~are_static_vals]
+    if(len(ratios) > 0 and np.isclose(ratios.sum(),1.0) == False):
+        raise ValueError("Sum of splits %r must equal 1.0" % float(ratios.sum()))
 
-    nums = [int(s) if(a) else int(s*length) for s, a in zip(splits, are_static_vals)]
-    out = []
-    start = 0
-    for n in nums:
-        out.append((start, n))
-        start += n
-    return out
+    nums = np.where(are_static_vals, splits, splits*length).astype(np.int64)
+    starts = np.cumsum(nums) - nums
+    return [(int(start), int(n)) for start, n in zip(starts, nums)]
 
 
 
-def procsFrom_label_dir_pairs(start, samples_per_label, stride, archive_dir,label_dir_pairs, object_profiles, observ_types, single_list=False, sort_columns=None, sort_ascending=True, data_keys=["X", 'Y'], verbose=1):
+def procsFrom_label_dir_pairs(start, samples_per_label, stride, archive_dir,label_dir_pairs, object_profiles, observ_types, single_list=False, sort_columns=None, sort_ascending=True, data_keys=["X", 'Y'], verbose=1, dtype='float32'):
     '''Gets a list of DataProcedures that use preprocessFromPandas_label_dir_pairs to read from the unjoined pandas files
         #Arguments
             start -- Where to start reading in the filesystem (if we treat it as one long list for each directory)
@@ -806,6 +897,7 @@ def procsFrom_label_dir_pairs(start, samples_per_label, stride, archive_dir,labe
             object_profiles -- A list of ObjectProfiles, used to determine what preprocessing steps need to be taken
             observ_types -- A list of the observable quantities in our pandas tables i.e ['E/c', "Px" ,,,etc.]
             verbose -- Whether or not to print
+            dtype -- The numpy dtype of the preprocessed data
     '''
     procs = []
     end = start+samples_per_label
@@ -825,7 +917,8 @@ def procsFrom_label_dir_pairs(start, samples_per_label, stride, archive_dir,labe
                 'single_list':single_list,
                 'sort_columns':sort_columns,
                 'sort_ascending':sort_ascending,
-                'verbose':verbose
+                'verbose':verbose,
+                'dtype':dtype
                 },
                 data_keys = data_keys
             )
@@ -838,25 +931,7 @@ def procsFrom_label_dir_pairs(start, samples_per_label, stride, archive_dir,labe
     #print([p.hash() for p in procs])
     return procs
 
-class dataFetchThread(threading.Thread):
-
-    def __init__(self, proc, group=None, target=None, name=None,
-                 args=(), kwargs=None, verbose=None):
-        threading.Thread.__init__(self, group=group, target=target, name=name,
-                                  verbose=verbose)
-        self.proc = proc
-        self.args = args
-        self.kwargs = kwargs
-        self.X = None
-        self.Y = None
-        return
-
-    def run(self):
-        self.X, self.Y = self.proc.get_data()
-        return
-
-
-def genFrom_label_dir_pairs(start, samples_per_label, stride, batch_size, archive_dir,label_dir_pairs, object_profiles, observ_types, verbose=1):
+def genFrom_label_dir_pairs(start, samples_per_label, stride, batch_size, archive_dir,label_dir_pairs, object_profiles, observ_types, prefetch=0, num_processes=1, verbose=1):
     '''Gets a data generator that use DataProcedures and preprocessFromPandas_label_dir_pairs to read from the unjoined pandas files
         and archive the results.
         #Arguments
@@ -871,6 +946,8 @@ def genFrom_label_dir_pairs(start, samples_per_label, stride, batch_size, archiv
                                 and where to find it.
             object_profiles -- A list of ObjectProfiles, used to determine what preprocessing steps need to be taken
             observ_types -- A list of the observable quantities in our pandas tables i.e ['E/c', "Px" ,,,etc.]
+            prefetch -- How many DataProcedures to read ahead in a background thread (see CMS_Deep_Learning.io.gen_from_data)
+            num_processes -- How many processes to read the DataProcedures with (see CMS_Deep_Learning.io.gen_from_data)
             verbose -- Whether or not to print
     '''
     dps = procsFrom_label_dir_pairs(start,
@@ -881,29 +958,42 @@ def genFrom_label_dir_pairs(start, samples_per_label, stride, batch_size, archiv
                                     object_profiles,
                                     observ_types,
                                     verbose=verbose)
-    gen = gen_from_data(dps, batch_size, threading = False, verbose=verbose)
+    gen = gen_from_data(dps, batch_size, prefetch=prefetch, num_processes=num_processes, verbose=verbose)
     return gen
 
-def XY_to_CSV(X,Y, csvdir):
-    '''Writes a pair of data X and Y to a directory csvdir as .csv files'''
-    if(csvdir[len(csvdir)-1] != "/"):
-        csvdir = csvdir + "/"
-    if(not os.path.isdir(csvdir)):
-        os.makedirs(csvdir)
-    X_path = csvdir+"X/"
-    Y_path = csvdir+"Y/"
-    if(not os.path.isdir(X_path)):
-        os.makedirs(X_path)
-    if(not os.path.isdir(Y_path)):
-        os.makedirs(Y_path)
+def _listShards(path):
+    '''Helper Function - Lists the files in a directory written by one of the XY_to_* functions in the order
+        that they were written, i.e X_2 before X_10'''
+    #Like glob, skip hidden files
+    names = [n for n in os.listdir(path) if not n.startswith(".")]
+    names.sort(key=lambda n: [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', n)])
+    return [os.path.join(path, n) for n in names]
+
+def _makeXYDirs(directory):
+    '''Helper Function - Makes the X and Y directories inside directory if they do not exist and returns their paths'''
+    X_path = os.path.join(directory, "X")
+    Y_path = os.path.join(directory, "Y")
+    for path in [X_path, Y_path]:
+        if(not os.path.isdir(path)):
+            os.makedirs(path)
+    return X_path, Y_path
+
+#Buffer size for reading and writing .csv files. savetxt writes line by line so a large buffer saves syscalls
+CSV_BUFFER_SIZE = 1 << 20
+
+def XY_to_CSV(X,Y, csvdir, dtype='float32'):
+    '''Writes a pair of data X and Y to a directory csvdir as .csv files. Prefer XY_to_npy unless you need text files.
+        The data is cast to dtype before it is written, use dtype=None to keep the dtype of the data.'''
+    X_path, Y_path = _makeXYDirs(csvdir)
     if(not isinstance(X, list)): X = [X]
     if(not isinstance(Y, list)): Y = [Y]
     def writeit(obj, path, strbeginning):
+        obj = np.ascontiguousarray(obj, dtype=dtype)
         shape = obj.shape
-        p = path+strbeginning + str(i) + ".csv"
-        f = open(p, "wb")
+        p = os.path.join(path, "%s%i.csv" % (strbeginning, i))
+        f = open(p, "w", buffering=CSV_BUFFER_SIZE)
         f.write("#Shape: "+str(shape)+"\n")
-        reshaped = np.reshape(obj, (shape[0], np.prod(shape[1:])))
+        reshaped = np.reshape(obj, (shape[0], int(np.prod(shape[1:]))))
         np.savetxt(f, reshaped, delimiter=",")
         f.close()
     for i,x in enumerate(X):
@@ -913,83 +1003,124 @@ def XY_to_CSV(X,Y, csvdir):
         writeit(y, Y_path, "Y_")
 
 
-def XY_from_CSV(csvdir):
-    '''Reads a pair of data X and Y from a directory csvdir that contains .csv files with the data'''
-    if(csvdir[len(csvdir)-1] != "/"):
-        csvdir = csvdir + "/"
+def XY_from_CSV(csvdir, dtype='float32'):
+    '''Reads a pair of data X and Y from a directory csvdir that contains .csv files with the data as arrays of
+        the given dtype'''
     def readit(path):
-        f = open(path, "rb")
-        shape_str = f.readline()
-        shape = tuple([int(re.sub("\D", "", s)) for s in shape_str.split(",")])
-        arr = np.loadtxt(f,delimiter=',')
+        f = open(path, "r", buffering=CSV_BUFFER_SIZE)
+        try:
+            #The first line looks like #Shape: (100, 20, 4)
+            shape_str = f.readline()
+            shape = tuple(ast.literal_eval(shape_str.split(":", 1)[1].strip()))
+            if(np.prod(shape) == 0):
+                return np.zeros(shape, dtype=dtype)
+            arr = pd.read_csv(f, header=None, dtype=dtype, engine='c', float_precision='round_trip').values
+        finally:
+            f.close()
         return np.reshape(arr, shape)
-    X_path = csvdir+"X/"
-    Y_path = csvdir+"Y/"
+    X_path = os.path.join(csvdir, "X")
+    Y_path = os.path.join(csvdir, "Y")
     if(not os.path.isdir(X_path) or not os.path.isdir(Y_path)):
         raise IOError("csv directory does not contain X/, Y/")
    
-    files = glob.glob(X_path+"*")
-    files.sort()
     X = []
-    for p in files:
+    for p in _listShards(X_path):
         X.append(readit(p))
         
-    files = glob.glob(Y_path+"*")
-    files.sort()
     Y = []
-    for p in files:
+    for p in _listShards(Y_path):
         Y.append(readit(p))
         
     return X,Y
 
 
-def XY_to_pickle(X,Y, pickledir):
-    '''Writes a pair of data X and Y to a directory pickledir as pickled files'''
-    if(pickledir[len(pickledir)-1] != "/"):
-        pickledir = pickledir + "/"
-    if(not os.path.isdir(pickledir)):
-        os.makedirs(pickledir)
-    X_path = pickledir+"X/"
-    Y_path = pickledir+"Y/"
-    if(not os.path.isdir(X_path)):
-        os.makedirs(X_path)
-    if(not os.path.isdir(Y_path)):
-        os.makedirs(Y_path)
+def XY_to_npy(X,Y, npydir, dtype='float32'):
+    '''Writes a pair of data X and Y to a directory npydir as binary .npy files. These are much smaller and
+        faster to read and write than the files written by XY_to_CSV. The data is cast to dtype before it is
+        written, use dtype=None to keep the dtype of the data.'''
+    X_path, Y_path = _makeXYDirs(npydir)
     if(not isinstance(X, list)): X = [X]
     if(not isinstance(Y, list)): Y = [Y]
-    def writeit(obj, path, strbeginning):
-        shape = obj.shape
-        p = path+strbeginning + str(i) 
-        np.save(p,obj)
     for i,x in enumerate(X):
-        writeit(x, X_path, "X_")
+        np.save(os.path.join(X_path, "X_%i.npy" % i), np.asarray(x, dtype=dtype))
         
     for i,y in enumerate(Y):
-        writeit(y, Y_path, "Y_")
-
-def XY_from_pickle(pickledir):
-    '''Reads a pair of data X and Y from a directory pickledir that contains pickle files with the data'''
-    if(pickledir[len(pickledir)-1] != "/"):
-        pickledir = pickledir + "/"
-    def readit(path):
-        arr = np.load(path)
-        return arr
-    X_path = pickledir+"X/"
-    Y_path = pickledir+"Y/"
+        np.save(os.path.join(Y_path, "Y_%i.npy" % i), np.asarray(y, dtype=dtype))
+
+def XY_from_npy(npydir, mmap_mode='r'):
+    '''Reads a pair of data X and Y from a directory npydir that contains .npy files with the data. By default
+        the arrays are memory-mapped so that only the parts of them that are used are read from disk.
+        Use mmap_mode=None to read them into memory.'''
+    X_path = os.path.join(npydir, "X")
+    Y_path = os.path.join(npydir, "Y")
     if(not os.path.isdir(X_path) or not os.path.isdir(Y_path)):
-        raise IOError("Pickle directory does not contain X/, Y/")
+        raise IOError("npy directory does not contain X/, Y/")
    
-    files = glob.glob(X_path+"*")
-    files.sort()
-    X = []
-    for p in files:
-        X.append(readit(p))
-        
-    files = glob.glob(Y_path+"*")
-    files.sort()
-    Y = []
-    for p in files:
-        Y.append(readit(p))
+    X = [np.load(p, mmap_mode=mmap_mode) for p in _listShards(X_path)]
+    Y = [np.load(p, mmap_mode=mmap_mode) for p in _listShards(Y_path)]
         
     return X,Y
 
+#The files opened by XY_from_h5, by absolute path, so that XY_to_h5 can close them before overwriting one
+_OPEN_H5_FILES = {}
+
+def _readOpenDatasets(D, path):
+    '''Helper Function - Reads the h5py datasets in D that belong to the file at path into memory'''
+    return [np.asarray(d) if isinstance(d, h5py.Dataset) and d.id.valid
+                             and os.path.abspath(d.file.filename) == path else d for d in D]
+
+def XY_to_h5(X,Y, filepath, chunk_size=100, dtype='float32'):
+    '''Writes a pair of data X and Y to a single .h5 file with groups X/ and Y/ holding one dataset per array.
+        The datasets are chunked along the sample axis in chunks of chunk_size samples (i.e the batch size)
+        so that reading a batch only touches the chunks that it needs. The data is cast to dtype before it is
+        written, use dtype=None to keep the dtype of the data. If XY_from_h5 left filepath open it is closed
+        first, after reading any of its datasets that are in X or Y into memory.'''
+    directory = os.path.dirname(os.path.abspath(filepath))
+    if(not os.path.isdir(directory)):
+        os.makedirs(directory)
+    if(not isinstance(X, list)): X = [X]
+    if(not isinstance(Y, list)): Y = [Y]
+    #h5py can not truncate a file that is still open
+    path = os.path.abspath(filepath)
+    open_files = _OPEN_H5_FILES.pop(path, [])
+    if(len(open_files) > 0):
+        X = _readOpenDatasets(X, path)
+        Y = _readOpenDatasets(Y, path)
+        for f in open_files:
+            f.close()
+    h5f = h5py.File(filepath, 'w')
+    try:
+        for key, D in [("X", X), ("Y", Y)]:
+            group = h5f.create_group(key)
+            for i, d in enumerate(D):
+                d = np.asarray(d, dtype=dtype)
+                chunks = None
+                if(d.ndim > 0 and d.size > 0):
+                    chunks = (min(chunk_size, len(d)),) + d.shape[1:]
+                group.create_dataset(str(i), data=d, chunks=chunks)
+    finally:
+        h5f.close()
+
+def XY_from_h5(filepath):
+    '''Reads a pair of data X and Y from a .h5 file written by XY_to_h5. The h5py datasets are returned
+        without being read, so slicing them (i.e X[0][start:end]) only reads those samples from disk.
+        The file stays open while the datasets are in use, close it with X[0].file.close() when done.
+        XY_to_h5 closes it itself before overwriting the file.'''
+    if(not os.path.isfile(filepath)):
+        raise IOError("No such file %r" % filepath)
+    h5f = h5py.File(filepath, 'r')
+    if(not "X" in h5f or not "Y" in h5f):
+        h5f.close()
+        raise IOError("h5 file %r does not contain X/, Y/" % filepath)
+    _OPEN_H5_FILES.setdefault(os.path.abspath(filepath), []).append(h5f)
+    X = [h5f["X"][k] for k in sorted(h5f["X"].keys(), key=int)]
+    Y = [h5f["Y"][k] for k in sorted(h5f["Y"].keys(), key=int)]
+    return X,Y
+
+def XY_to_pickle(X,Y, pickledir, dtype='float32'):
+    '''Writes a pair of data X and Y to a directory pickledir as pickled files (see XY_to_npy)'''
+    XY_to_npy(X, Y, pickledir, dtype=dtype)
+
+def XY_from_pickle(pickledir):
+    '''Reads a pair of data X and Y from a directory pickledir that contains pickle files with the data (see XY_from_npy)'''
+    return XY_from_npy(pickledir, mmap_mode=None)
@@ -321,19 +321,24 @@ class DataProcedure(Storable):
             out = data[:]
         return out
         
-    def get_data(self, archive=True, redo=False,data_keys=["X","Y"], verbose=1):
-        '''Apply the DataProcedure returning X,Y from the archive or generating them from func'''
+    def get_data(self, archive=True, redo=False,data_keys=["X","Y"], driver=None, verbose=1):
+        '''Apply the DataProcedure returning X,Y from the archive or generating them from func.
+            driver is the h5py driver used to read the archive. Since the whole archive is read anyway,
+            driver='core' reads the file in one sequential pass instead of one read per chunk, at the cost
+            of holding a copy of the file in memory while it is decoded.'''
         # if verbose == 1: raise ValueError()
         if(self.is_archived() and redo == False):
             h5_file = None
             try:
-                h5_file = h5py.File("/".join([self.get_path(), 'archive.h5']), 'r')
+                data_path = "/".join([self.get_path(), 'archive.h5'])
+                h5_file = open_h5(data_path, driver=driver)
                 out = []
                 for data_key in data_keys:
                     data = h5_file[data_key]
                     o = self.load_hdf5_data(data)
                     out.append(o)
                 out = tuple(out)
+                h5_file.close()
                 if(verbose >= 1): print("DataProcedure results %r read from archive" % self.hash())
             except IOError as e:
                 print(e)
@@ -1194,6 +1199,9 @@ def compute_hash(inp):
     hashable_str = inp
     if(isinstance(inp, Storable)):
         hashable_str = inp.to_hashable()
+    #hashlib takes bytes on python 3, the encoding leaves python 2 hashes unchanged
+    if(not isinstance(hashable_str, bytes)):
+        hashable_str = hashable_str.encode("utf-8")
     h = hashlib.sha1()
     h.update(hashable_str)
     return h.hexdigest()
@@ -1240,6 +1248,13 @@ def get_blob_path(*args, **kwargs):
     return blob_path
 
 
+def open_h5(path, driver=None):
+    '''Opens an .h5 file for reading with the given h5py driver'''
+    if(driver == 'core'):
+        #Only read the file into memory, never write it back
+        return h5py.File(path, 'r', driver='core', backing_store=False)
+    return h5py.File(path, 'r', driver=driver)
+
 def read_data_archive(archive_dir, verbose=0):
     '''Returns the data archive read from the trial directory'''
     return read_json_obj(archive_dir, 'data_archive.json')
@@ -0,0 +1,95 @@
+'''Tight loops used by CMS_Deep_Learning.preprocessing. These are compiled with numba when it is
+    installed and otherwise fall back to plain numpy implementations with the same results.'''
+import numpy as np
+
+try:
+    from numba import njit, types
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+def _pad_sort_block_numpy(vals, offsets, max_size, sort_cols, ascending, out):
+    '''Numpy version of pad_sort_block'''
+    counts = np.minimum(np.diff(offsets), max_size)
+    for i, n in enumerate(counts):
+        x = vals[offsets[i]:offsets[i] + n]
+        if (len(sort_cols) > 0):
+            # lexsort treats the last key as the primary one. It is stable, and negating the keys for a
+            # descending sort keeps tied rows in their original order like the numba version does.
+            keys = x[:, sort_cols[::-1]].T
+            order = np.lexsort(keys if ascending else -keys)
+            x = x[order]
+        out[i, :n] = x
+    return counts
+
+
+if (HAS_NUMBA):
+    #Compile eagerly for the dtypes used by preprocessing so that the first call does not pay for the JIT.
+    #With cache=True the compiled kernels are reused across runs.
+    #The values are often read only views of a pandas table. Writable arrays also match a read only signature.
+    #The kernels are not compiled with parallel=True, since starting numba's threading layer (i.e tbb) in a
+    #process stops it from exiting after it forks a multiprocessing.Pool. Use num_processes for parallelism.
+    _VALS_TYPES = [types.Array(t, 2, 'C', readonly=True) for t in (types.float32, types.float64)]
+    _INDEX_TYPE = types.Array(types.int64, 1, 'A')
+    _ROW_SIGS = [types.boolean(v, types.int64, types.int64, _INDEX_TYPE, types.boolean) for v in _VALS_TYPES]
+    _BLOCK_SIGS = [_INDEX_TYPE(v, _INDEX_TYPE, types.int64, _INDEX_TYPE, types.boolean, types.Array(v.dtype, 3, 'A'))
+                   for v in _VALS_TYPES]
+
+    @njit(_ROW_SIGS, cache=True)
+    def _row_before(vals, a, b, sort_cols, ascending):
+        '''True if row a of vals comes strictly before row b when sorting on sort_cols'''
+        for c in sort_cols:
+            if (vals[a, c] != vals[b, c]):
+                return (vals[a, c] < vals[b, c]) == ascending
+        return False
+
+    @njit(_BLOCK_SIGS, cache=True)
+    def _pad_sort_block_numba(vals, offsets, max_size, sort_cols, ascending, out):
+        '''Numba version of pad_sort_block'''
+        num_entries = len(offsets) - 1
+        counts = np.empty(num_entries, dtype=np.int64)
+        for i in range(num_entries):
+            s = offsets[i]
+            n = min(offsets[i + 1] - s, max_size)
+            # Insertion sort on the row order. Entries are small so this beats allocating for argsort.
+            order = np.arange(n)
+            for j in range(1, n):
+                o = order[j]
+                m = j
+                while m > 0 and _row_before(vals, s + o, s + order[m - 1], sort_cols, ascending):
+                    order[m] = order[m - 1]
+                    m -= 1
+                order[m] = o
+            for j in range(n):
+                for k in range(vals.shape[1]):
+                    out[i, j, k] = vals[s + order[j], k]
+            counts[i] = n
+        return counts
+
+
+def pad_sort_block(vals, offsets, max_size, sort_cols, ascending, out):
+    '''Cuts each entry of a table down to max_size rows, sorts those rows and writes them into a block of
+        padded entries.
+
+        :param vals: The (rows, vecsize) table with the rows of each entry stored contiguously
+        :type vals: numpy.ndarray
+        :param offsets: The row where each entry starts, entry i covers rows [offsets[i], offsets[i+1])
+        :type offsets: numpy.ndarray of int64
+        :param max_size: The maximum number of rows to keep for each entry
+        :type max_size: int
+        :param sort_cols: The columns to sort on, the first being the primary key. Empty for no sorting.
+        :type sort_cols: numpy.ndarray of int64
+        :param ascending: Whether to sort ascending or descending
+        :type ascending: bool
+        :param out: A zeroed (entries, max_size, vecsize) array to write into
+        :type out: numpy.ndarray
+        :returns: The number of rows written for each entry
+    '''
+    #The numba kernels are only compiled for single and double precision
+    if (HAS_NUMBA and out.dtype in (np.float32, np.float64)):
+        vals = np.ascontiguousarray(vals, dtype=out.dtype)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        sort_cols = np.asarray(sort_cols, dtype=np.int64)
+        return _pad_sort_block_numba(vals, offsets, max_size, sort_cols, bool(ascending), out)
+    return _pad_sort_block_numpy(vals, offsets, max_size, sort_cols, ascending, out)
@@ -0,0 +1,144 @@
+from __future__ import absolute_import
+
+import unittest
+import sys, os
+if __package__ is None:
+    sys.path.append(os.path.realpath("../"))
+import tempfile
+import numpy as np
+from CMS_Deep_Learning.storage.archiving import DataProcedure
+import h5py
+import multiprocessing
+import threading
+import time
+from CMS_Deep_Learning.io import DataIterator, gen_from_data, retrieve_data, restructure, restructurer, _prefetch, \
+                                 _read_ahead, _copy_to_buffers
+
+
+def make_XY(start, num):
+    '''Makes num samples of X,Y data that identify the samples start...start+num'''
+    X = np.arange(start * 6, (start + num) * 6, dtype='float32').reshape(num, 3, 2)
+    Y = np.arange(start, start + num, dtype='float32').reshape(num, 1)
+    return X, Y
+
+
+def write_XY_files(sizes):
+    '''Writes a .h5 file with X and Y datasets for each size, numbering the samples across the files in order.
+        Returns the file paths and the X, Y data of all of the files joined together.'''
+    directory = tempfile.mkdtemp()
+    files, Xs, Ys = [], [], []
+    start = 0
+    for i, size in enumerate(sizes):
+        X, Y = make_XY(start, size)
+        path = os.path.join(directory, "%03i.h5" % i)
+        h5f = h5py.File(path, 'w')
+        h5f.create_dataset("X", data=X)
+        h5f.create_dataset("Y", data=Y)
+        h5f.close()
+        files.append(path)
+        Xs.append(X)
+        Ys.append(Y)
+        start += size
+    return files, Xs, Ys
+
+
+def raise_after(n):
+    for i in range(n):
+        yield i
+    raise ValueError("Failed after %r" % n)
+
+
+class IOTests(unittest.TestCase):
+    def test_core_driver(self):
+        archive_dir = tempfile.mkdtemp()
+        dp = DataProcedure(archive_dir, True, make_XY, args=[0, 7])
+        X, Y = dp.get_data(verbose=0)
+        self.assertTrue(dp.is_archived())
+        #Archived arrays are read back as lists of arrays
+        X_read, Y_read = retrieve_data(dp, data_keys=["X", "Y"])
+        X_core, Y_core = retrieve_data(dp, data_keys=["X", "Y"], driver='core')
+        self.assertTrue(np.array_equal(X_core[0], X_read[0]) and np.array_equal(Y_core[0], Y_read[0]))
+        self.assertTrue(np.array_equal(X_core[0], X) and np.array_equal(Y_core[0], Y))
+
+        batches = gen_from_data([dp, dp], 5, data_keys=["X", "Y"], driver='core', verbose=0)
+        for start in [0, 5, 0, 5]:
+            x, y = next(batches)
+            self.assertTrue(np.array_equal(x, X[start:start + 5]) and np.array_equal(y, Y[start:start + 5]))
+
+    def test_gen_from_data_options(self):
+        files, Xs, Ys = write_XY_files([7, 12, 5])
+        batch_size = 5
+        #Batches do not cross files, so the last batch of each file can be short
+        expected = [(X[s:s + batch_size], Y[s:s + batch_size])
+                    for X, Y in zip(Xs, Ys) for s in range(0, len(X), batch_size)]
+        nbytes = Xs[0].nbytes + Ys[0].nbytes
+        options = [{}, dict(prefetch=2), dict(cache_megabytes=1.5 * nbytes / 1e6), dict(cache_megabytes=100),
+                   dict(num_buffers=2), dict(num_processes=2),
+                   dict(prefetch=2, cache_megabytes=1.5 * nbytes / 1e6, num_buffers=2, num_processes=2)]
+        for kw in options:
+            batches = gen_from_data(files, batch_size, data_keys=["X", "Y"], verbose=0, **kw)
+            #Run through three epochs so that cached data is used
+            for epoch in range(3):
+                for X, Y in expected:
+                    x, y = next(batches)
+                    self.assertTrue(np.array_equal(x, X) and np.array_equal(y, Y), msg="Wrong batch with %r" % kw)
+            batches.close()
+
+    def test_as_list(self):
+        files, Xs, Ys = write_XY_files([7, 12, 5])
+        X, Y = DataIterator(files, data_keys=["X", "Y"]).as_list()
+        self.assertTrue(np.array_equal(X, np.concatenate(Xs)) and np.array_equal(Y, np.concatenate(Ys)))
+        X, Y = DataIterator(files, num_samples=10, data_keys=["X", "Y"]).as_list()
+        self.assertTrue(np.array_equal(X, np.concatenate(Xs)[:10]) and np.array_equal(Y, np.concatenate(Ys)[:10]))
+        #The data runs out before num_samples, only the samples that were read are returned
+        X, Y = DataIterator(files, num_samples=100, data_keys=["X", "Y"]).as_list()
+        self.assertTrue(np.array_equal(X, np.concatenate(Xs)) and np.array_equal(Y, np.concatenate(Ys)))
+
+    def test_restructurer(self):
+        flat = [np.zeros((2, i)) for i in range(5)]
+        for data_keys in ["X", ["X", "Y"], [["A", "B"], "Y"], ["X", ["A", ["B", "C"]], "Y"]]:
+            self.assertEqual(repr(restructurer(data_keys)(flat)), repr(restructure(flat, data_keys)))
+        #Flat keys need no restructuring so the list is not copied
+        batch = flat[:2]
+        self.assertTrue(restructurer(["X", "Y"])(batch) is batch)
+
+    def test_prefetch(self):
+        self.assertEqual(list(_prefetch(range(20), 3)), list(range(20)))
+        out = []
+        with self.assertRaises(ValueError):
+            for x in _prefetch(raise_after(4), 2):
+                out.append(x)
+        self.assertEqual(out, list(range(4)))
+        #Closing the generator while the queue is full still ends the thread, even when it then fails
+        before = threading.active_count()
+        gen = _prefetch(raise_after(2), 1)
+        next(gen)
+        time.sleep(.3)
+        gen.close()
+        time.sleep(.5)
+        self.assertEqual(threading.active_count(), before)
+
+    def test_read_ahead(self):
+        pool = multiprocessing.Pool(2)
+        try:
+            self.assertEqual(list(_read_ahead(pool, abs, range(0, -20, -1), 3)), list(range(20)))
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_copy_to_buffers(self):
+        X, Y = make_XY(0, 7)
+        buffers, batch = _copy_to_buffers([X[:5], Y[:5]], None, 5)
+        self.assertTrue(np.array_equal(batch[0], X[:5]) and np.array_equal(batch[1], Y[:5]))
+        #A shorter batch of the same shapes reuses the buffers
+        reused, batch = _copy_to_buffers([X[5:], Y[5:]], buffers, 5)
+        self.assertTrue(reused[0] is buffers[0] and batch[0].base is buffers[0])
+        self.assertTrue(np.array_equal(batch[0], X[5:]) and np.array_equal(batch[1], Y[5:]))
+        #Different shapes get new buffers
+        new, batch = _copy_to_buffers([X[:5, 0], Y[:5]], buffers, 5)
+        self.assertFalse(new[0] is buffers[0])
+        self.assertTrue(np.array_equal(batch[0], X[:5, 0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -119,14 +119,17 @@ def fake_frames(N,object_profiles, marker=None, nb_eflow=3,std_eflow=1):
         
     #print(frames["EventChars"])
     #print(frames["Jets"])
+    #EventChars are read using the MissingET counts
+    num_val_dict["MissingET"] = num_val_dict["EventChars"]
     frames["NumValues"] = pd.DataFrame(num_val_dict)
     # print("NOOOOOP",num_val_dict)
     return frames
 
 def store_frames(frames, filepath):
-    store = pd.HDFStore(filepath)
+    #Overwrite the file so that no tables are left over from earlier tests (empty tables are not written)
+    store = pd.HDFStore(filepath, mode='w')
     for key,frame in frames.items():
-        store.put(key, frame, format='table')
+        store.put(key, frame.infer_objects(), format='table')
     store.close()
     
 
@@ -192,7 +195,8 @@ def checkGeneralSanity(t, X, Y, frame_lists, sizes,  NUM, label_dir_pairs):
                     ok = 0
                     for label, frame in all_values_by_label.items():
                         frame = pd.concat(frame)
-                        frame = frame.drop("Entry", axis=1)
+                        #Compare at the precision of the output (float32 by default)
+                        frame = frame.drop("Entry", axis=1).astype(x.dtype)
                         if((frame == row).all(1).any()):
                             ok += 1
                             tn[4][label] = True
@@ -341,6 +345,8 @@ class PreprocessingTests(unittest.TestCase):
         #SORTED
         X, Y, Jets,EventChars = preprocessFromPandas_label_dir_pairs(label_dir_pairs,0, NUM, OPS, observ_types, verbose=1)
         print(Jets,EventChars)
+        self.assertEqual([x.dtype for x in X] + [Y.dtype, Jets.dtype, EventChars.dtype],
+                         [np.dtype(np.float32)] * (len(OPS) + 3))
         # print([x.shape for x in X], Y.shape)
         sizes = np.array([[len(label_dir_pairs)*NUM, p.max_size, vecsize] for p in OPS])
         checkGeneralSanity(self,X, Y, frame_lists, sizes,  NUM, label_dir_pairs)
@@ -421,6 +427,151 @@ class PreprocessingTests(unittest.TestCase):
         # print(zip(x_check, y_check))
         self.assertTrue(np.array_equal(x_check, y_check))
 
+    def test_num_processes_exits(self):
+        #A process that used the kernels and then forked a pool must still be able to exit
+        import subprocess, threading
+        NUM = 20
+        frame_lists = {l: store_fake(d, NUM, 1, object_profiles1) for l, d in label_dir_pairs}
+        script = "\n".join(["import sys",
+                            "sys.path.insert(0, 'tests')",
+                            "from test_preprocessing import *",
+                            "from CMS_Deep_Learning.preprocessing.preprocessing import resolveProfileMaxes",
+                            "preprocessFromPandas_label_dir_pairs(label_dir_pairs, 0, %r, object_profiles1, observ_types, verbose=0)" % NUM,
+                            "preprocessFromPandas_label_dir_pairs(label_dir_pairs, 0, %r, object_profiles1, observ_types, verbose=0, num_processes=3)" % NUM,
+                            "resolveProfileMaxes([ObjectProfile('EFlowPhoton', -1)], label_dir_pairs, num_processes=2)"])
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root + os.pathsep + os.environ.get("PYTHONPATH", ""))
+        proc = subprocess.Popen([sys.executable, "-c", script], cwd=root, env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        timer = threading.Timer(120, proc.kill)
+        timer.start()
+        try:
+            output = proc.communicate()[0]
+        finally:
+            timer.cancel()
+        self.assertEqual(proc.returncode, 0, msg=output)
+
+    def test_num_processes_matches_serial(self):
+        directory = tempfile.mkdtemp()
+        pairs = [(l, os.path.join(directory, l) + "/") for l, d in label_dir_pairs]
+        np.random.seed(0)
+        for l, d in pairs:
+            store_fake(d, 10, 3, object_profiles1)
+        for OPS, single_list in [(object_profiles1, False), (object_profiles1, True), (RAND_OPS, False)]:
+            outs = []
+            for num_processes in [1, 3]:
+                np.random.seed(1)
+                outs.append(preprocessFromPandas_label_dir_pairs(pairs, 5, 20, OPS, observ_types, verbose=0,
+                                                                 single_list=single_list, num_processes=num_processes))
+            (X, Y, Jets, EventChars), (X_p, Y_p, Jets_p, EventChars_p) = outs
+            for a, b in zip(list(X) + [Y, Jets, EventChars], list(X_p) + [Y_p, Jets_p, EventChars_p]):
+                self.assertTrue(np.array_equal(a, b), msg="num_processes=3 differs with single_list=%r %r" % (single_list, [p.sort_columns for p in OPS]))
+
+    def test_store_closed_on_error(self):
+        directory = tempfile.mkdtemp() + "/"
+        frames = fake_frames(3, object_profiles1)
+        frames["NumValues"] = frames["NumValues"].drop("MissingET", axis=1)
+        store_frames(frames, directory + "000.h5")
+        self.assertRaises(KeyError, preprocessFromPandas_label_dir_pairs, [("ttbar", directory)], 0, 3,
+                          object_profiles1, observ_types, verbose=0)
+        #Fails if the file was left open in read only mode
+        store_frames(frames, directory + "000.h5")
+
+    def test_pad_sort_block(self):
+        from CMS_Deep_Learning.utils import _preproc_kernels as K
+        #Round so that there are ties to break
+        vals = np.random.randint(0, 3, (12, 3)).astype(np.float64)
+        offsets = np.array([0, 5, 5, 7, 12], dtype=np.int64)
+        for sort_cols, ascending in [([], True), ([1], True), ([2, 0], False)]:
+            sort_cols = np.array(sort_cols, dtype=np.int64)
+            expected = np.zeros((4, 3, 3))
+            counts = K._pad_sort_block_numpy(vals, offsets, 3, sort_cols, ascending, expected)
+            self.assertTrue(np.array_equal(counts, [3, 0, 2, 3]))
+            out = np.zeros((4, 3, 3))
+            self.assertTrue(np.array_equal(K.pad_sort_block(vals, offsets, 3, sort_cols, ascending, out), counts))
+            self.assertTrue(np.array_equal(out, expected))
+            self.assertTrue(np.array_equal(out[1], np.zeros((3, 3))))
+        #Tied rows keep their order in a descending sort
+        vals = np.array([[1., 5.], [2., 6.], [1., 7.]])
+        for f in [K._pad_sort_block_numpy, K.pad_sort_block]:
+            out = np.zeros((1, 3, 2))
+            f(vals, np.array([0, 3], dtype=np.int64), 3, np.array([0], dtype=np.int64), False, out)
+            self.assertTrue(np.array_equal(out[0], [[2., 6.], [1., 5.], [1., 7.]]))
+
+    def test_fillBlock_query(self):
+        from CMS_Deep_Learning.preprocessing.preprocessing import _fillBlock
+        frame = pd.DataFrame({"Entry": [0, 0, 0, 1, 2, 2], "PT": [5., 1., 7., 2., 9., 3.]})
+        offsets = np.array([0, 3, 4, 6], dtype=np.int64)
+        profile = ObjectProfile("Jet", 2, pre_sort_columns=["PT"], pre_sort_ascending=False, query="PT > 2.5")
+        block, counts = _fillBlock(frame, offsets, profile, ["PT"])
+        self.assertTrue(np.array_equal(counts, [2, 0, 2]))
+        self.assertTrue(np.array_equal(block[:, :, 0], [[7., 5.], [0., 0.], [9., 3.]]))
+        self.assertEqual(block.dtype, np.float32)
+        block, _ = _fillBlock(frame, offsets, profile, ["PT"], dtype='float64')
+        self.assertEqual(block.dtype, np.float64)
+
+    def test_getFiles_StoreType(self):
+        from CMS_Deep_Learning.preprocessing.preprocessing import getFiles_StoreType
+        directory = tempfile.mkdtemp()
+        for name in ["000.h5", "001.h5"]:
+            open(os.path.join(directory, name), "w").close()
+        for d in [directory, directory + "/"]:
+            files, storeType = getFiles_StoreType(d)
+            self.assertEqual(storeType, "hdf5")
+            self.assertEqual(sorted(files), [os.path.join(d, "000.h5"), os.path.join(d, "001.h5")])
+            self.assertTrue(all([os.path.isfile(f) for f in files]))
+
+    def test_XY_npy_shard_order(self):
+        from CMS_Deep_Learning.preprocessing.preprocessing import XY_to_npy, XY_from_npy
+        X = [np.full((2, 3), i) for i in range(12)]
+        d = tempfile.mkdtemp()
+        XY_to_npy(X, X, d)
+        X_read, Y_read = XY_from_npy(d)
+        self.assertEqual([int(x[0, 0]) for x in X_read], list(range(12)))
+
+    def test_XY_CSV_round_trip(self):
+        from CMS_Deep_Learning.preprocessing.preprocessing import XY_to_CSV, XY_from_CSV
+        X = [np.random.rand(11, 4, 3), np.zeros((0, 4, 3))]
+        Y = [np.random.rand(11), np.zeros(0)]
+        d = tempfile.mkdtemp()
+        XY_to_CSV(X, Y, d)
+        X_read, Y_read = XY_from_CSV(d)
+        for orig, read in zip(X + Y, X_read + Y_read):
+            self.assertEqual(read.shape, orig.shape)
+            self.assertEqual(read.dtype, np.float32)
+            self.assertTrue(np.array_equal(read, orig.astype(np.float32)))
+
+        #With dtype=None float64 values come back exactly
+        d = tempfile.mkdtemp()
+        XY_to_CSV(X, Y, d, dtype=None)
+        X_read, Y_read = XY_from_CSV(d, dtype=None)
+        for orig, read in zip(X + Y, X_read + Y_read):
+            self.assertEqual(read.shape, orig.shape)
+            self.assertEqual(read.dtype, np.float64)
+            self.assertTrue(np.array_equal(read, orig))
+
+    def test_XY_h5_round_trip(self):
+        from CMS_Deep_Learning.preprocessing.preprocessing import XY_to_h5, XY_from_h5
+        X = [np.random.rand(250, 4, 3), np.random.rand(7, 2), np.zeros((0, 4, 3))]
+        Y = [np.random.rand(250), np.zeros(0)]
+        path = os.path.join(tempfile.mkdtemp(), "XY.h5")
+        XY_to_h5(X, Y, path, chunk_size=100)
+        X_read, Y_read = XY_from_h5(path)
+        self.assertEqual([x.chunks for x in X_read], [(100, 4, 3), (7, 2), None])
+        self.assertEqual([y.chunks for y in Y_read], [(100,), None])
+        for orig, read in zip(X + Y, X_read + Y_read):
+            self.assertEqual(read.shape, orig.shape)
+            self.assertEqual(read.dtype, np.float32)
+            self.assertTrue(np.array_equal(read[:], orig.astype(np.float32)))
+
+        #Overwriting a file that XY_from_h5 still has open, with its own datasets
+        XY_to_h5(X_read[:1], Y_read[:1], path, dtype=None)
+        X_read, Y_read = XY_from_h5(path)
+        self.assertEqual(len(X_read), 1)
+        self.assertTrue(np.array_equal(X_read[0][:], X[0].astype(np.float32)))
+        self.assertTrue(np.array_equal(Y_read[0][:], Y[0].astype(np.float32)))
+        X_read[0].file.close()
+
 if __name__ == '__main__':
     # unittest.main()
     speedTest()